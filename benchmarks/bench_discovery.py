@@ -0,0 +1,78 @@
+# Time for a client to discover N providers on localhost
+import asyncio
+import threading
+import time
+import uuid
+from client.discovery_client import ClientDiscovery
+from client.service_repository import ServiceRepository
+from service_provider.discovery_service import ServiceDiscoveryBroadcaster
+
+
+def _service_info(index):
+    return {
+        "serviceId": str(uuid.uuid4()),
+        "serviceName": "BenchmarkService",
+        "serviceVersion": "1.0.0",
+        "endpoint": f"localhost:{9000 + index}",
+        "capabilities": {"echo": {"status": "Ready", "settings": []}},
+        "status": "Online",
+        "load": 0.0
+    }
+
+
+def run(providers=5, timeout=10.0, transport="broadcast"):
+    """
+    Start `providers` discovery broadcasters (one primary, the rest secondaries
+    registered with it) and measure how long one client discovery round takes
+    to find all of them. Needs the discovery ports to be free on this host.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="bench-discovery", daemon=True).start()
+    broadcasters = []
+    discovery = None
+    try:
+        for index in range(providers):
+            # Secondaries register with the primary while constructing, so the
+            # primary must already be serving on the loop
+            broadcaster = ServiceDiscoveryBroadcaster(_service_info(index))
+            asyncio.run_coroutine_threadsafe(broadcaster.start_async(), loop).result(5)
+            broadcasters.append(broadcaster)
+        registered = sum(1 for b in broadcasters if b.is_primary or b.primary_provider_addr)
+
+        repository = ServiceRepository()
+        found = threading.Event()
+        first_seen = []
+
+        def on_change(event, service_info):
+            first_seen.append(time.perf_counter())
+            if len(repository.services) >= registered:
+                found.set()
+
+        repository.add_listener(on_change)
+        discovery = ClientDiscovery(str(uuid.uuid4()), repository, transport=transport)
+        start = time.perf_counter()
+        asyncio.run_coroutine_threadsafe(discovery.start_async(), loop).result(5)
+        converged = found.wait(timeout)
+        elapsed = time.perf_counter() - start
+
+        result = {
+            "providers": providers,
+            "registered": registered,
+            "discovered": len(repository.services),
+            "transport": transport,
+            "converged": converged
+        }
+        if first_seen:
+            result["firstServiceMs"] = round((first_seen[0] - start) * 1000, 3)
+        if converged:
+            result["convergenceMs"] = round(elapsed * 1000, 3)
+        return result
+    finally:
+        def stop_all():
+            if discovery is not None:
+                discovery.stop()
+            for broadcaster in reversed(broadcasters):
+                broadcaster.stop()
+        loop.call_soon_threadsafe(stop_all)
+        time.sleep(0.1)
+        loop.call_soon_threadsafe(loop.stop)
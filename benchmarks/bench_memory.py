@@ -0,0 +1,47 @@
+# Provider memory used per 1000 tracked tasks
+import gc
+import time
+import tracemalloc
+from benchmarks.common import BenchProvider
+from shared.messages import build_message, MessageTypes
+
+
+def run(tasks=5000, payload_bytes=256):
+    """
+    Assign `tasks` echo tasks directly to a provider (no network) and report
+    the memory still allocated once they have all finished, i.e. what the
+    provider keeps per tracked task and its result.
+    """
+    provider = BenchProvider(port=0)
+    payload = "x" * payload_bytes
+    messages = [build_message(MessageTypes.ASSIGN_TASK, {
+        "taskId": f"mem-{i}",
+        "operation": "echo",
+        "taskParameters": {"payload": payload}
+    }) for i in range(tasks)]
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for message in messages:
+            provider.handle_assign_message(message, None)
+        while provider.executor.in_flight():
+            time.sleep(0.01)
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        provider.executor.shutdown()
+
+    retained = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    store = provider.task_store.stats()
+    return {
+        "tasks": tasks,
+        "payloadBytes": payload_bytes,
+        "trackedTasks": store["tasks"],
+        "bytesPer1kTasks": int(retained * 1000 / max(store["tasks"], 1)),
+        "peakBytes": peak,
+        "storeResultBytes": store["memoryBytes"]
+    }
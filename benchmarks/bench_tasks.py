@@ -0,0 +1,103 @@
+# Task throughput and AssignTask -> pushed result latency against a localhost provider
+import concurrent.futures
+import threading
+import time
+from benchmarks.common import BenchProvider, ProviderThread, latency_summary
+from client.connection_pool import ConnectionPool
+from client.ws_client import ServiceWebSocketClient
+from shared.messages import build_message, MessageTypes
+
+# A task without a result this long after submission counts as failed (and timed out)
+TASK_TIMEOUT_SEC = 30
+
+
+def _run_single(client, tasks, concurrency, prefix):
+    """Submit tasks one AssignTask each, keeping `concurrency` of them in flight"""
+    window = threading.Semaphore(concurrency)
+    latencies = []
+    failures = []
+    timed_out = [0]
+    done = threading.Event()
+    remaining = [tasks]
+    lock = threading.Lock()
+
+    def on_done(started, future):
+        finished = time.perf_counter()
+        with lock:
+            if isinstance(future.exception(), concurrent.futures.TimeoutError):
+                timed_out[0] += 1
+                failures.append(future)
+            elif future.exception() or future.result().get("type") != MessageTypes.TASK_RESULT:
+                failures.append(future)
+            else:
+                latencies.append(finished - started)
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                done.set()
+        window.release()
+
+    start = time.perf_counter()
+    for i in range(tasks):
+        window.acquire()
+        message = build_message(MessageTypes.ASSIGN_TASK, {
+            "taskId": f"{prefix}-{i}",
+            "operation": "echo",
+            "taskParameters": {"index": i}
+        })
+        started = time.perf_counter()
+        client.submit_task(message, timeout=TASK_TIMEOUT_SEC).add_done_callback(lambda f, s=started: on_done(s, f))
+    # Every task times out on its own; this only guards against lost callbacks
+    finished = done.wait(TASK_TIMEOUT_SEC)
+    elapsed = time.perf_counter() - start
+    with lock:
+        lost = 0 if finished else remaining[0]
+
+    result = {"tasks": tasks, "concurrency": concurrency, "failed": len(failures) + lost,
+              "timedOut": timed_out[0] + lost, "seconds": round(elapsed, 3), "tasksPerSec": round(tasks / elapsed, 1)}
+    if latencies:
+        result["latency"] = latency_summary(latencies)
+    return result
+
+
+def _run_batched(client, tasks, batch_size, prefix):
+    """Submit tasks with AssignTaskBatch and wait for every pushed result"""
+    start = time.perf_counter()
+    futures = []
+    for offset in range(0, tasks, batch_size):
+        batch = [{"taskId": f"{prefix}-{i}", "operation": "echo", "taskParameters": {"index": i}}
+                 for i in range(offset, min(offset + batch_size, tasks))]
+        futures.extend(client.submit_task_batch(batch))
+    deadline = time.perf_counter() + TASK_TIMEOUT_SEC
+    failed = timed_out = 0
+    for future in futures:
+        try:
+            if future.result(max(0, deadline - time.perf_counter())).get("type") != MessageTypes.TASK_RESULT:
+                failed += 1
+        except concurrent.futures.TimeoutError:
+            failed += 1
+            timed_out += 1
+        except Exception:
+            failed += 1
+    elapsed = time.perf_counter() - start
+    return {"tasks": tasks, "batchSize": batch_size, "failed": failed, "timedOut": timed_out,
+            "seconds": round(elapsed, 3), "tasksPerSec": round(tasks / elapsed, 1)}
+
+
+def run(tasks=2000, concurrency=64, batch_size=100, port=8790, wire_format=None):
+    """Throughput and latency of single and batched task submission"""
+    provider = ProviderThread(BenchProvider(port)).start()
+    pool = ConnectionPool(wire_format=wire_format)
+    try:
+        client = ServiceWebSocketClient(provider.endpoint, pool=pool)
+        # Warm up the connection and the worker threads
+        _run_single(client, min(tasks, 100), concurrency, "warmup")
+        single = _run_single(client, tasks, concurrency, "single")
+        batched = _run_batched(client, tasks, batch_size, "batch")
+        return {
+            "wireFormat": pool.stats().get(provider.endpoint, {}).get("wireFormats"),
+            "single": single,
+            "batched": batched
+        }
+    finally:
+        pool.close()
+        provider.stop()
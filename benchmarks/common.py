@@ -0,0 +1,79 @@
+# Shared helpers for the benchmark suite: an in-process provider and result statistics
+import asyncio
+import threading
+import time
+from service_provider.service_provider_base import ServiceProviderBase
+
+
+class BenchProvider(ServiceProviderBase):
+    """Provider whose tasks do (almost) no work, so the benchmarks measure the framework"""
+
+    MAX_WORKERS    = 8
+    MAX_QUEUE_SIZE = 100000
+
+    def __init__(self, port):
+        super().__init__("BenchmarkService", "1.0.0", port, {
+            "echo": {"status": "Ready", "settings": [{"object": "payload"}]},
+            "sleep": {"status": "Ready", "settings": [{"float": "seconds"}]}
+        })
+
+    def handle_assign_task(self, task_id, operation, parameters, base_result):
+        if operation == "sleep":
+            time.sleep(parameters.get("seconds", 0.01))
+        base_result["payload"]["resultData"] = parameters
+        self.complete_task(task_id, base_result)
+
+
+class ProviderThread:
+    """Runs a provider's WebSocket server on its own event loop in a daemon thread"""
+
+    def __init__(self, provider, host="127.0.0.1"):
+        self.provider = provider
+        self.host = host
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="bench-provider", daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(self.provider.start_server(self.host))
+        self.ready.set()
+        self.loop.run_forever()
+
+    def start(self, timeout=10):
+        self.thread.start()
+        if not self.ready.wait(timeout):
+            raise RuntimeError("Benchmark provider did not start")
+        return self
+
+    @property
+    def endpoint(self):
+        return f"ws://{self.host}:{self.provider.PORT}"
+
+    def stop(self):
+        async def shutdown():
+            self.server.close()
+            await self.server.wait_closed()
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+        self.provider.executor.shutdown()
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def latency_summary(samples_sec):
+    """p50/p99/max of latencies in seconds, reported in milliseconds"""
+    return {
+        "p50Ms": round(percentile(samples_sec, 50) * 1000, 3),
+        "p99Ms": round(percentile(samples_sec, 99) * 1000, 3),
+        "maxMs": round(max(samples_sec) * 1000, 3)
+    }
@@ -0,0 +1,98 @@
+# Run the benchmark suite and write machine-readable results
+#
+#   python -m benchmarks.run_benchmarks --output bench.json
+#   python -m benchmarks.run_benchmarks --baseline bench.json   # exit code 1 on regressions
+import argparse
+import json
+import platform
+import sys
+import time
+from benchmarks import bench_discovery, bench_memory, bench_tasks
+
+BENCHMARKS = ("tasks", "discovery", "memory")
+
+# Metrics compared against a baseline: (benchmark, path, True when higher is better)
+TRACKED_METRICS = [
+    ("tasks", "single.tasksPerSec", True),
+    ("tasks", "single.latency.p50Ms", False),
+    ("tasks", "single.latency.p99Ms", False),
+    ("tasks", "batched.tasksPerSec", True),
+    ("discovery", "convergenceMs", False),
+    ("memory", "bytesPer1kTasks", False)
+]
+
+
+def run_suite(args):
+    results = {}
+    if "tasks" in args.only:
+        print("Running task throughput/latency benchmark...", file=sys.stderr)
+        results["tasks"] = bench_tasks.run(args.tasks, args.concurrency, args.batch_size, args.port, args.wire_format)
+    if "discovery" in args.only:
+        print(f"Running discovery benchmark with {args.providers} providers...", file=sys.stderr)
+        results["discovery"] = bench_discovery.run(args.providers, transport=args.transport)
+    if "memory" in args.only:
+        print("Running task memory benchmark...", file=sys.stderr)
+        results["memory"] = bench_memory.run(args.memory_tasks)
+    return {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results
+    }
+
+
+def _lookup(results, benchmark, path):
+    value = results.get(benchmark)
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare(report, baseline, tolerance):
+    """List the tracked metrics that got worse than the baseline by more than `tolerance`"""
+    regressions = []
+    for benchmark, path, higher_is_better in TRACKED_METRICS:
+        current = _lookup(report["results"], benchmark, path)
+        previous = _lookup(baseline["results"], benchmark, path)
+        if current is None or previous is None or previous == 0:
+            continue
+        change = (current - previous) / previous
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append({"metric": f"{benchmark}.{path}", "baseline": previous,
+                                "current": current, "change": round(change, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Service-Oriented API Interface benchmarks")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--tasks", type=int, default=2000, help="tasks per throughput run")
+    parser.add_argument("--concurrency", type=int, default=64, help="tasks in flight for single submission")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--port", type=int, default=8790, help="WebSocket port of the benchmark provider")
+    parser.add_argument("--wire-format", choices=["json", "msgpack"], default=None)
+    parser.add_argument("--providers", type=int, default=5, help="providers for the discovery benchmark")
+    parser.add_argument("--transport", choices=["broadcast", "multicast", "sweep"], default="broadcast")
+    parser.add_argument("--memory-tasks", type=int, default=5000)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    report = run_suite(args)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,387 @@
+# Persistent WebSocket connection pool shared by service provider clients
+import asyncio
+import threading
+import time
+import websockets
+from client.request_cache import RequestCache, DEFAULT_MAX_RESULTS
+from shared.messages import build_message, generate_uuid, MessageTypes, DEFAULT_STREAM_WINDOW
+from shared.serialization import client_subprotocols, codec_for
+
+DEFAULT_MAX_CONNECTIONS_PER_ENDPOINT = 4
+DEFAULT_IDLE_TIMEOUT_SEC = 60
+DEFAULT_PING_INTERVAL_SEC = 20
+DEFAULT_PING_TIMEOUT_SEC = 10
+DEFAULT_REQUEST_TIMEOUT_SEC = 30
+
+# Task statuses in a reply after which the provider pushes nothing more for the task
+UNWATCHED_TASK_STATUSES = ("Rejected", "Unknown")
+
+
+class TaskStreamError(Exception):
+    """The provider could not deliver a streamed task result"""
+
+
+class BackgroundEventLoop:
+    """Runs one asyncio event loop in a daemon thread"""
+
+    def __init__(self, name="ws-client-loop"):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_loop_thread(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, coro):
+        """Schedule a coroutine on the loop and return a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class PooledConnection:
+    """A long-lived WebSocket that multiplexes requests correlated by messageId"""
+
+    def __init__(self, pool, endpoint, websocket):
+        self.pool = pool
+        self.endpoint = endpoint
+        self.websocket = websocket
+        self.codec = codec_for(websocket.subprotocol)
+        self.pending = {}  # request messageId -> asyncio.Future
+        self.streams = {}  # stream request messageId -> asyncio.Queue of frames
+        self.tasks = set()  # taskIds assigned or subscribed here, whose updates arrive on this connection
+        self.last_used = time.monotonic()
+        self.closed = False
+        self.reader = asyncio.ensure_future(self._read_loop())
+
+    @property
+    def in_flight(self):
+        return len(self.pending) + len(self.streams)
+
+    async def request(self, message, timeout):
+        message_id = message.setdefault("messageId", generate_uuid())
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message_id] = future
+        self.last_used = time.monotonic()
+        self.tasks.update(_pushed_task_ids(message))
+        try:
+            await self.websocket.send(self.codec.encode(message))
+            response = await asyncio.wait_for(future, timeout)
+            for entry in response.get("tasks", [response]):
+                if entry.get("taskStatus") in UNWATCHED_TASK_STATUSES:
+                    self.tasks.discard(entry.get("taskId"))
+            return response
+        finally:
+            self.pending.pop(message_id, None)
+            self.last_used = time.monotonic()
+
+    async def stream(self, message, window, timeout):
+        """
+        Send a GetResultStream request and yield the data of each chunk. Credit
+        for more chunks is granted as chunks are consumed, so at most `window`
+        chunks are ever buffered. `timeout` applies between two frames.
+        """
+        message_id = message.setdefault("messageId", generate_uuid())
+        task_id = message["payload"]["taskId"]
+        message["payload"]["credit"] = window
+        queue = asyncio.Queue()
+        self.streams[message_id] = queue
+        self.last_used = time.monotonic()
+        finished = False
+        consumed = 0
+        try:
+            await self.websocket.send(self.codec.encode(message))
+            while True:
+                frame = await asyncio.wait_for(queue.get(), timeout)
+                if isinstance(frame, Exception):
+                    raise frame
+                if frame.get("type") != MessageTypes.TASK_RESULT_CHUNK:
+                    finished = True
+                    if frame.get("type") == MessageTypes.TASK_FAILED:
+                        raise TaskStreamError(frame.get("payload", {}).get("errorMessage"))
+                    return
+                yield frame["payload"]["data"]
+                consumed += 1
+                if consumed >= max(window // 2, 1):
+                    await self.websocket.send(self.codec.encode(build_message(
+                        MessageTypes.STREAM_CREDIT, {"taskId": task_id, "credit": consumed})))
+                    consumed = 0
+        finally:
+            self.streams.pop(message_id, None)
+            self.last_used = time.monotonic()
+            if not finished and not self.closed:
+                # Stopped reading early: let the provider drop the stream
+                try:
+                    await self.websocket.send(self.codec.encode(build_message(
+                        MessageTypes.STREAM_CREDIT, {"taskId": task_id, "close": True})))
+                except Exception:
+                    pass
+
+    async def ping(self, timeout):
+        """Health check an idle connection, closing it if the provider does not answer"""
+        try:
+            pong = await self.websocket.ping()
+            await asyncio.wait_for(pong, timeout)
+            return True
+        except Exception:
+            await self.close()
+            return False
+
+    async def close(self):
+        self.closed = True
+        await self.websocket.close()
+
+    async def _read_loop(self):
+        try:
+            async for raw in self.websocket:
+                self._dispatch(self.codec.decode(raw))
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            print(f"WebSocket client read error from {self.endpoint}: {e}")
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Connection to {self.endpoint} closed"))
+            for queue in self.streams.values():
+                queue.put_nowait(ConnectionError(f"Connection to {self.endpoint} closed"))
+            # Updates of these tasks were pushed here; nothing will arrive for them now
+            for task_id in self.tasks:
+                self.pool._fail_task_listeners(task_id, ConnectionError(
+                    f"Connection to {self.endpoint} closed before task {task_id} finished"))
+            self.tasks.clear()
+            self.pool._discard(self)
+
+    def _dispatch(self, response):
+        queue = self.streams.get(response.get("replyTo"))
+        if queue is not None:
+            queue.put_nowait(response)
+            return
+        if response.get("type") in (MessageTypes.TASK_RESULT_CHUNK, MessageTypes.TASK_RESULT_END):
+            return  # Frames still in flight for a stream the caller stopped reading
+        future = self.pending.get(response.get("replyTo"))
+        if future is not None and not future.done():
+            future.set_result(response)
+        else:
+            if response.get("type") in (MessageTypes.TASK_RESULT, MessageTypes.TASK_FAILED):
+                self.tasks.discard(response.get("payload", {}).get("taskId"))
+            self.pool._handle_unsolicited(self, response)
+
+
+class ConnectionPool:
+    """
+    Keeps long-lived WebSocket connections to service providers on a single
+    background event loop. Requests to the same endpoint are spread over at most
+    `max_connections_per_endpoint` connections and matched to their responses by
+    the `replyTo` field the provider echoes from the request's messageId.
+
+    Connections offer the subprotocols of `wire_format` ("msgpack", "json", or
+    None for the most compact available) and fall back to JSON with providers
+    that do not negotiate one.
+
+    GetStatus/GetResult requests go through a RequestCache shared by every
+    client of the pool: identical concurrent requests are sent once and up to
+    `max_cached_results` final task results are answered locally.
+    """
+
+    def __init__(self, max_connections_per_endpoint=DEFAULT_MAX_CONNECTIONS_PER_ENDPOINT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT_SEC, ping_interval=DEFAULT_PING_INTERVAL_SEC,
+                 ping_timeout=DEFAULT_PING_TIMEOUT_SEC, request_timeout=DEFAULT_REQUEST_TIMEOUT_SEC,
+                 wire_format=None, max_cached_results=DEFAULT_MAX_RESULTS):
+        self.max_connections_per_endpoint = max_connections_per_endpoint
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.request_timeout = request_timeout
+        self.subprotocols = client_subprotocols(wire_format)
+        self.connections = {}  # endpoint -> [PooledConnection]
+        self._opening = {}     # endpoint -> {asyncio.Task}
+        self.task_listeners = {}  # taskId -> [callback(message)]
+        self._listeners_lock = threading.Lock()
+        self.request_cache = RequestCache(max_cached_results)
+        self._runner = BackgroundEventLoop()
+        self.loop = self._runner.loop
+        self._maintenance = self._runner.submit(self._maintain())
+
+    def request(self, endpoint, message, timeout=None, ssl_context=None):
+        """Send a message and return a concurrent.futures.Future for its response"""
+        if self._runner.in_loop_thread():
+            raise RuntimeError("Blocking pool requests cannot be made from the pool's own event loop")
+        return self._runner.submit(self._request(endpoint, message, timeout, ssl_context))
+
+    async def request_async(self, endpoint, message, timeout=None, ssl_context=None):
+        """Awaitable variant of request() usable from any event loop"""
+        coro = self._request(endpoint, message, timeout, ssl_context)
+        if self._runner.in_loop_thread():
+            return await coro
+        return await asyncio.wrap_future(self._runner.submit(coro))
+
+    async def _request(self, endpoint, message, timeout, ssl_context):
+        async def send(message):
+            conn = await self._acquire(endpoint, ssl_context)
+            return await conn.request(message, timeout or self.request_timeout)
+        return await self.request_cache.fetch(endpoint, message, send, timeout or self.request_timeout)
+
+    async def stream(self, endpoint, message, window=DEFAULT_STREAM_WINDOW, timeout=None, ssl_context=None):
+        """Async iterator over the chunk data of a GetResultStream request, usable from any event loop"""
+        chunks = self._stream(endpoint, message, window, timeout or self.request_timeout, ssl_context)
+        if self._runner.in_loop_thread():
+            async for data in chunks:
+                yield data
+            return
+        try:
+            while True:
+                done, data = await asyncio.wrap_future(self._runner.submit(_next_chunk(chunks)))
+                if done:
+                    return
+                yield data
+        finally:
+            self._runner.submit(chunks.aclose())
+
+    async def _stream(self, endpoint, message, window, timeout, ssl_context):
+        conn = await self._acquire(endpoint, ssl_context)
+        async for data in conn.stream(message, window, timeout):
+            yield data
+
+    async def _acquire(self, endpoint, ssl_context):
+        while True:
+            conns = [c for c in self.connections.get(endpoint, []) if not c.closed]
+            opening = self._opening.setdefault(endpoint, set())
+            least_busy = min(conns, key=lambda c: c.in_flight, default=None)
+            at_capacity = len(conns) + len(opening) >= self.max_connections_per_endpoint
+
+            if least_busy is not None and (least_busy.in_flight == 0 or at_capacity):
+                return least_busy
+            if not at_capacity:
+                task = asyncio.ensure_future(self._open(endpoint, ssl_context))
+                opening.add(task)
+                task.add_done_callback(opening.discard)
+                return await task
+            # Every slot is still handshaking; wait for one of them and retry
+            await asyncio.wait(opening, return_when=asyncio.FIRST_COMPLETED)
+
+    async def _open(self, endpoint, ssl_context):
+        # Keepalive is handled by _maintain so busy connections are never pinged
+        websocket = await websockets.connect(endpoint, ssl=ssl_context, ping_interval=None,
+                                             subprotocols=self.subprotocols)
+        conn = PooledConnection(self, endpoint, websocket)
+        self.connections.setdefault(endpoint, []).append(conn)
+        return conn
+
+    def _discard(self, conn):
+        conns = self.connections.get(conn.endpoint, [])
+        if conn in conns:
+            conns.remove(conn)
+        if not conns:
+            self.connections.pop(conn.endpoint, None)
+
+    def add_task_listener(self, task_id, callback):
+        """Call `callback(message)` on the pool loop for every update pushed for a task"""
+        with self._listeners_lock:
+            self.task_listeners.setdefault(task_id, []).append(callback)
+
+    def remove_task_listener(self, task_id, callback):
+        with self._listeners_lock:
+            listeners = self.task_listeners.get(task_id, [])
+            if callback in listeners:
+                listeners.remove(callback)
+            if not listeners:
+                self.task_listeners.pop(task_id, None)
+
+    def _fail_task_listeners(self, task_id, error):
+        """Pass `error` to the listeners of a task whose updates can no longer arrive"""
+        with self._listeners_lock:
+            listeners = list(self.task_listeners.get(task_id, ()))
+        for callback in listeners:
+            try:
+                callback(error)
+            except Exception as e:
+                print(f"Task listener error for {task_id}: {e}")
+
+    def _handle_unsolicited(self, conn, message):
+        """Route provider pushes (TaskStatusUpdate/TaskResult/TaskFailed) to task listeners"""
+        task_id = message.get("payload", {}).get("taskId")
+        self.request_cache.store(conn.endpoint, message)
+        with self._listeners_lock:
+            listeners = list(self.task_listeners.get(task_id, ()))
+        if not listeners:
+            print(f"Ignoring unsolicited message from {conn.endpoint}: {message.get('type')}")
+        for callback in listeners:
+            try:
+                callback(message)
+            except Exception as e:
+                print(f"Task listener error for {task_id}: {e}")
+
+    async def _maintain(self):
+        """Evict idle connections and ping the ones kept around"""
+        interval = max(1, min(self.idle_timeout, self.ping_interval) / 2)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for conns in list(self.connections.values()):
+                for conn in list(conns):
+                    if conn.closed or conn.in_flight:
+                        continue
+                    idle_for = now - conn.last_used
+                    # Connections still due a task's pushed result are kept (and pinged)
+                    if idle_for >= self.idle_timeout and not conn.tasks:
+                        await conn.close()
+                    elif idle_for >= self.ping_interval:
+                        await conn.ping(self.ping_timeout)
+
+    def stats(self):
+        return {
+            endpoint: {
+                "connections": len(conns),
+                "wireFormats": sorted({c.codec.subprotocol for c in conns}),
+                "inFlight": sum(c.in_flight for c in conns)
+            }
+            for endpoint, conns in list(self.connections.items())
+        }
+
+    def close(self):
+        async def close_all():
+            self._maintenance.cancel()
+            for conns in list(self.connections.values()):
+                for conn in list(conns):
+                    await conn.close()
+        self._runner.submit(close_all()).result()
+        self._runner.stop()
+
+
+def _pushed_task_ids(message):
+    """taskIds whose updates the provider pushes to the connection sending `message`"""
+    msg_type = message.get("type")
+    payload = message.get("payload", {})
+    if msg_type in (MessageTypes.ASSIGN_TASK, MessageTypes.SUBSCRIBE_TASK):
+        return [payload.get("taskId")] if payload.get("taskId") else []
+    if msg_type == MessageTypes.ASSIGN_TASK_BATCH and payload.get("subscribe", True):
+        return [task.get("taskId") for task in payload.get("tasks", []) if task.get("taskId")]
+    return []
+
+
+async def _next_chunk(chunks):
+    # StopAsyncIteration cannot cross threads through a future, so report the end instead
+    try:
+        return False, await chunks.__anext__()
+    except StopAsyncIteration:
+        return True, None
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    """Return the process-wide connection pool, creating it on first use"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = ConnectionPool()
+        return _default_pool
@@ -1,53 +1,197 @@
 # UDP Discovery for client (Service Repository)
+import asyncio
 import socket
-import json
 import threading
 import time
+from collections import OrderedDict
 from shared import discovery
-from shared.discovery import UDP_CLIENT_DISCOVERY_PORT, UDP_SERVICE_DISCOVERY_PORT
-from shared.messages import MessageTypes
+from shared.discovery import UDP_CLIENT_DISCOVERY_PORT, UDP_SERVICE_DISCOVERY_PORT, DiscoveryDatagramProtocol
+from shared.discovery import SCHEMA_FIELDS, DISCOVERY_RECV_BUFFER_SIZE, MAX_DATAGRAM_SIZE, encode_datagram, decode_datagram, merge_advertisement
+from shared.messages import MessageTypes, build_message
+
+# Service descriptors (schema fields of full advertisements) kept per (serviceId, schemaVersion)
+DESCRIPTOR_CACHE_SIZE = 256
+DESCRIPTOR_FETCH_TIMEOUT_SEC = 10
+# Providers' heartbeats keep the repository fresh; the periodic request is
+# only a fallback for missed heartbeats and providers that joined unheard
+DISCOVERY_REFRESH_INTERVAL_SEC = 300
+
 
 class ClientDiscovery:
-    def __init__(self, client_id, repository):
+    def __init__(self, client_id, repository, transport=discovery.DEFAULT_DISCOVERY_TRANSPORT, pool=None):
         self.client_id = client_id
         self.repository = repository
+        self.transport = transport
+        # WebSocket pool used to fetch descriptors of pointer advertisements
+        self.pool = pool
+        self.descriptors = OrderedDict()  # (serviceId, schemaVersion) -> descriptor
+        self.descriptor_fetches = set()   # (serviceId, schemaVersion) being fetched
+        self.descriptors_lock = threading.Lock()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        # Bind to local UDP port for discovery
-        local_ip = discovery.get_local_ip()
-        self.sock.bind((local_ip, UDP_CLIENT_DISCOVERY_PORT))
+        if transport == discovery.DISCOVERY_TRANSPORT_MULTICAST:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, discovery.DISCOVERY_MULTICAST_TTL)
+        # Bind to the local UDP port on every address: a socket bound to one
+        # unicast address does not receive the primaries' broadcast heartbeats
+        self.sock.bind(('', UDP_CLIENT_DISCOVERY_PORT))
         self.running = False
+        self.last_stale_refresh = {}  # provider host -> time of the last targeted refresh
+        self.datagram_transport = None  # Set when running on an event loop (start_async)
+        self.discovery_task = None
 
-    def send_discovery_request(self):
-        """Send discovery requests to all target networks"""
+    def send_discovery_request(self, target_ip=None):
+        """
+        Send one discovery request per target of the configured transport, or
+        only to the primary provider on `target_ip`
+        """
         msg = {
             "discoveryType": MessageTypes.CLIENT_DISCOVERY_REQUEST,
             "clientId": self.client_id,
-            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
         }
+        # Serialize once; the same datagram goes to every target
+        data = self._encode_with_known_schemas(msg, self.repository.known_schemas())
+
+        if target_ip:
+            self._sendto(data, (target_ip, UDP_SERVICE_DISCOVERY_PORT))
+            return
+
+        print(f"Sending discovery request ({self.transport}).")
 
-        # Get all broadcast addresses for multi-network discovery
-        broadcast_addresses = discovery.get_broadcast_addresses()
+        if self.transport == discovery.DISCOVERY_TRANSPORT_MULTICAST:
+            self._send_multicast(data)
+            return
+
+        broadcast_addresses = discovery.get_discovery_targets(self.transport)
         if not broadcast_addresses:
             broadcast_addresses = ["192.168.255.255"]
 
-        print(f"Sending discovery request.")
-
         for broadcast_ip in broadcast_addresses:
             try:
                 broadcast_addr = (broadcast_ip, UDP_SERVICE_DISCOVERY_PORT)
-                self.sock.sendto(json.dumps(msg).encode(), broadcast_addr)
+                self._sendto(data, broadcast_addr)
             except Exception as e:
                 print(f"Failed to send discovery to {broadcast_ip}: {e}")
 
+    @staticmethod
+    def _encode_with_known_schemas(msg, known_schemas):
+        """
+        Encode a discovery request listing as many known schemas as fit in
+        MAX_DATAGRAM_SIZE. Providers whose schema we hold answer with a delta
+        advertisement; the ones left out answer with a full advertisement.
+        """
+        items = list(known_schemas.items())
+        while items:
+            data = encode_datagram(dict(msg, knownSchemas=dict(items)))
+            if len(data) <= MAX_DATAGRAM_SIZE:
+                return data
+            items = items[:len(items) // 2]
+        return encode_datagram(msg)
+
+    def _send_multicast(self, data):
+        """Send the request to the multicast group once out of each interface"""
+        group_addr = (discovery.DISCOVERY_MULTICAST_GROUP, UDP_SERVICE_DISCOVERY_PORT)
+        for interface in discovery.get_network_interfaces():
+            try:
+                self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface['ip']))
+                self._sendto(data, group_addr)
+            except Exception as e:
+                print(f"Failed to send multicast discovery on {interface['interface']}: {e}")
+
+    def _sendto(self, data, addr):
+        if self.datagram_transport is not None:
+            self.datagram_transport.sendto(data, addr)
+        else:
+            self.sock.sendto(data, addr)
+
+    def handle_message(self, msg, sender_addr=None):
+        if msg.get('discoveryType') == MessageTypes.SERVICE_ADVERTISEMENT_BATCH:
+            # A primary provider answering for itself and its registered providers
+            for advertisement in msg.get('advertisements') or []:
+                self.handle_message(advertisement, sender_addr)
+            return
+        if msg.get('discoveryType') != MessageTypes.SERVICE_ADVERTISEMENT:
+            return
+        if not (msg.get('delta') or msg.get('descriptorRef')):
+            self._remember_descriptor(msg.get('serviceId'), msg.get('schemaVersion'), msg)
+            self.repository.update_service(msg)
+            return
+        if self.repository.apply_delta(msg):
+            return
+
+        key = (msg.get('serviceId'), msg.get('schemaVersion'))
+        with self.descriptors_lock:
+            descriptor = self.descriptors.get(key)
+        if descriptor is not None:
+            self.repository.update_service(merge_advertisement(descriptor, msg))
+        elif msg.get('descriptorRef'):
+            self._fetch_descriptor(msg, sender_addr)
+        else:
+            # We lack this schema (expired, new provider, or the provider changed
+            # it); ask only the primary on the sender's host, which claims no or
+            # an outdated version, so its providers answer in full
+            host = sender_addr[0] if sender_addr else None
+            now = time.monotonic()
+            if now - self.last_stale_refresh.get(host, 0.0) >= 1.0:
+                self.last_stale_refresh[host] = now
+                self.send_discovery_request(target_ip=host)
+
+    def _remember_descriptor(self, service_id, schema_version, service_info):
+        if not service_id or not schema_version:
+            return
+        with self.descriptors_lock:
+            self.descriptors[(service_id, schema_version)] = {f: service_info.get(f) for f in SCHEMA_FIELDS}
+            self.descriptors.move_to_end((service_id, schema_version))
+            while len(self.descriptors) > DESCRIPTOR_CACHE_SIZE:
+                self.descriptors.popitem(last=False)
+
+    def _fetch_descriptor(self, pointer, sender_addr):
+        """Resolve a pointer advertisement by fetching its descriptor over WebSocket, without blocking discovery"""
+        key = (pointer.get('serviceId'), pointer.get('schemaVersion'))
+        with self.descriptors_lock:
+            if key in self.descriptor_fetches:
+                return
+            self.descriptor_fetches.add(key)
+        if self.pool is None:
+            from client.connection_pool import get_default_pool
+            self.pool = get_default_pool()
+
+        def on_reply(reply):
+            with self.descriptors_lock:
+                self.descriptor_fetches.discard(key)
+            try:
+                descriptor = reply.result()
+            except Exception as e:
+                print(f"Failed to fetch descriptor of {key[0]}: {e}")
+                return
+            if descriptor.get('type') != MessageTypes.DESCRIPTOR:
+                print(f"Unexpected descriptor reply from {key[0]}: {descriptor.get('type')}")
+                return
+            self._remember_descriptor(key[0], descriptor.get('schemaVersion'), descriptor)
+            merged = merge_advertisement(descriptor, pointer)
+            merged['schemaVersion'] = descriptor.get('schemaVersion')
+            self.repository.update_service(merged)
+
+        message = build_message(MessageTypes.GET_DESCRIPTOR, {"serviceId": key[0]})
+        url = self._descriptor_url(pointer.get('endpoint'), sender_addr)
+        self.pool.request(url, message, DESCRIPTOR_FETCH_TIMEOUT_SEC).add_done_callback(on_reply)
+
+    def _descriptor_url(self, endpoint, sender_addr):
+        endpoint = endpoint or ''
+        if '://' in endpoint:
+            return endpoint
+        host, _, port = endpoint.rpartition(':')
+        # Providers often advertise a local host name; reach them where the datagram came from
+        if sender_addr and host in ('', 'localhost', '127.0.0.1', '0.0.0.0'):
+            host = sender_addr[0]
+        return f"ws://{host}:{port}"
+
     def listen(self):
         self.running = True
         while self.running:
             try:
-                data, _ = self.sock.recvfrom(4096)
-                msg = json.loads(data.decode())
-                if msg.get('discoveryType') == MessageTypes.SERVICE_ADVERTISEMENT:
-                    self.repository.update_service(msg)
+                data, sender_addr = self.sock.recvfrom(DISCOVERY_RECV_BUFFER_SIZE)
+                self.handle_message(decode_datagram(data), sender_addr)
             except Exception as e:
                 print(f"Discovery listen error: {e}")
 
@@ -56,11 +200,29 @@ class ClientDiscovery:
         self.send_discovery_request()
         threading.Thread(target=self.periodic_discovery, daemon=True).start()
 
+    async def start_async(self):
+        """Run discovery on the current event loop instead of listener and refresh threads"""
+        loop = asyncio.get_running_loop()
+        self.running = True
+        self.datagram_transport, _ = await loop.create_datagram_endpoint(
+            lambda: DiscoveryDatagramProtocol(self.handle_message, "Discovery"), sock=self.sock)
+        self.send_discovery_request()
+        self.discovery_task = asyncio.ensure_future(self._periodic_discovery_async())
+
+    async def _periodic_discovery_async(self):
+        while self.running:
+            await asyncio.sleep(DISCOVERY_REFRESH_INTERVAL_SEC)
+            self.send_discovery_request()
+
     def periodic_discovery(self):
         while self.running:
+            time.sleep(DISCOVERY_REFRESH_INTERVAL_SEC)
             self.send_discovery_request()
-            time.sleep(300)  # every 5 minutes
 
     def stop(self):
         self.running = False
+        if self.discovery_task is not None:
+            self.discovery_task.cancel()
+        if self.datagram_transport is not None:
+            self.datagram_transport.close()
         self.sock.close()
@@ -0,0 +1,101 @@
+# Coalesces identical GetStatus/GetResult requests and keeps final task results client-side
+import asyncio
+import threading
+from collections import OrderedDict
+from shared.messages import MessageTypes
+
+DEFAULT_MAX_RESULTS = 1024
+
+COALESCED_REQUESTS = (MessageTypes.GET_STATUS, MessageTypes.GET_RESULT)
+FINAL_TASK_MESSAGES = (MessageTypes.TASK_RESULT, MessageTypes.TASK_FAILED)
+
+
+def is_final_result(message):
+    """True for a TaskResult/TaskFailed of a finished task (not the "Result not ready" reply)"""
+    return (isinstance(message, dict) and message.get("type") in FINAL_TASK_MESSAGES
+            and "error" not in message)
+
+
+class RequestCache:
+    """
+    Sits in front of a connection pool's requests. GetStatus and GetResult
+    requests for the same task on the same endpoint that are in flight at the
+    same time share one wire request; every caller gets its own copy of the
+    reply. Final TaskResult/TaskFailed messages, whether replies to GetResult or
+    pushed by the provider, are kept by (endpoint, taskId) and answer later
+    GetResult calls without a round trip. At most `max_results` are kept, least
+    recently used first out; 0 disables the result cache but keeps coalescing.
+
+    fetch() must run on the pool's event loop.
+    """
+
+    def __init__(self, max_results=DEFAULT_MAX_RESULTS):
+        self.max_results = max_results
+        self.results = OrderedDict()  # (endpoint, taskId) -> final result message
+        self.inflight = {}            # (endpoint, type, taskId) -> asyncio.Future of the reply
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evicted": 0}
+
+    async def fetch(self, endpoint, message, send, timeout=None):
+        """Reply to `message`, calling `send(message)` only when no cached or in-flight reply can be reused"""
+        task_id = message.get("payload", {}).get("taskId")
+        if message.get("type") not in COALESCED_REQUESTS or not task_id:
+            return await send(message)
+        if message["type"] == MessageTypes.GET_RESULT:
+            cached = self.get(endpoint, task_id)
+            if cached is not None:
+                return cached
+
+        key = (endpoint, message["type"], task_id)
+        running = self.inflight.get(key)
+        if running is None:
+            self._count("misses")
+            running = asyncio.ensure_future(send(message))
+            self.inflight[key] = running
+            running.add_done_callback(lambda f: self._finish(key, f))
+        else:
+            self._count("coalesced")
+        # Shielded so one caller giving up does not cancel the request for the others
+        response = await asyncio.wait_for(asyncio.shield(running), timeout)
+        return dict(response)
+
+    def get(self, endpoint, task_id):
+        """Copy of the cached final result of a task, or None"""
+        with self.lock:
+            result = self.results.get((endpoint, task_id))
+            if result is None:
+                return None
+            self.results.move_to_end((endpoint, task_id))
+            self.counters["hits"] += 1
+            return dict(result)
+
+    def store(self, endpoint, message):
+        """Keep `message` if it is the final result of a task"""
+        task_id = message.get("payload", {}).get("taskId") if isinstance(message, dict) else None
+        if not self.max_results or not task_id or not is_final_result(message):
+            return
+        result = dict(message)
+        result.pop("replyTo", None)
+        with self.lock:
+            self.results[(endpoint, task_id)] = result
+            self.results.move_to_end((endpoint, task_id))
+            while len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+                self.counters["evicted"] += 1
+
+    def _finish(self, key, future):
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+        if not future.cancelled() and future.exception() is None:
+            self.store(key[0], future.result())
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["results"] = len(self.results)
+            stats["inflight"] = len(self.inflight)
+            return stats
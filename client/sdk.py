@@ -0,0 +1,168 @@
+# Headless asyncio client: discover providers and run tasks on them without a GUI
+import asyncio
+import random
+import uuid
+from client.connection_pool import get_default_pool
+from client.discovery_client import ClientDiscovery
+from client.service_repository import ServiceRepository
+from client.ws_client import ServiceWebSocketClient
+from shared.messages import build_message, MessageTypes
+
+DEFAULT_SUBMIT_CONCURRENCY = 64
+SERVICE_WAIT_POLL_SEC = 0.1
+
+# Rejections worth retrying: the provider is full now but may not be shortly
+RETRYABLE_REJECTIONS = ("Busy", "Saturated")
+BUSY_RETRIES = 5
+BUSY_RETRY_DELAY_SEC = 0.05
+BUSY_RETRY_MAX_DELAY_SEC = 1.0
+
+
+class ServiceUnavailable(Exception):
+    """No online provider offers the requested service and operation"""
+
+
+class TaskFailedError(Exception):
+    """A task ended with TaskFailed or was rejected; `message` is the provider's reply"""
+
+    def __init__(self, message):
+        payload = message.get("payload", {})
+        reason = payload.get("errorMessage") or message.get("reason") or message.get("taskStatus") or "Task failed"
+        super().__init__(reason)
+        self.message = message
+
+
+class AsyncServiceClient:
+    """
+    Runs tasks on discovered providers from asyncio code:
+
+        client = AsyncServiceClient()
+        await client.start()
+        await client.wait_for_service("ImageProcessingService", "resizeImage")
+        result = await client.submit("ImageProcessingService", "resizeImage", {"width": 64})
+        results = await client.submit_many("ImageProcessingService", "resizeImage", params_list)
+
+    Providers come from `repository`, filled by the ClientDiscovery that
+    start() runs on the current loop (skip start() when the repository is
+    fed elsewhere). Requests go over `pool`, by default the process-wide
+    connection pool, so tasks to one provider share its connections.
+    """
+
+    def __init__(self, repository=None, client_id=None, pool=None, strategy=None):
+        self.repository = repository or ServiceRepository()
+        self.client_id = client_id or str(uuid.uuid4())
+        self.pool = pool or get_default_pool()
+        self.strategy = strategy
+        self.clients = {}  # endpoint -> ServiceWebSocketClient
+        self.discovery = None
+
+    async def start(self, transport=None):
+        """Discover providers on the running event loop and expire the ones that go away"""
+        if self.discovery is not None:
+            return
+        options = {"transport": transport} if transport else {}
+        self.discovery = ClientDiscovery(self.client_id, self.repository, pool=self.pool, **options)
+        await self.discovery.start_async()
+        self.repository.start_expiry_sweeper()
+
+    def close(self):
+        """Stop discovery started by start(); the connection pool stays open"""
+        if self.discovery is not None:
+            self.discovery.stop()
+            self.repository.stop_expiry_sweeper()
+            self.discovery = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def wait_for_service(self, service_name, operation=None, timeout=None):
+        """Wait until a provider of `service_name` (and `operation`) is online; raises TimeoutError"""
+        async def poll():
+            while not self.repository.get_candidates(service_name, operation):
+                await asyncio.sleep(SERVICE_WAIT_POLL_SEC)
+        await asyncio.wait_for(poll(), timeout)
+
+    def client_for(self, service_info):
+        """ServiceWebSocketClient for a provider, reused across tasks"""
+        endpoint = service_info.get("endpoint") or ""
+        if "://" not in endpoint:
+            endpoint = f"ws://{endpoint}"
+        client = self.clients.get(endpoint)
+        if client is None:
+            client = self.clients[endpoint] = ServiceWebSocketClient(endpoint, pool=self.pool)
+        return client
+
+    def submit(self, service_name, operation, parameters=None, timeout=None, key=None, on_update=None):
+        """
+        Assign a task to a provider picked by the repository's selection
+        strategy (`key` is the consistent-hash task key) and return an
+        asyncio.Future for its TaskResult message. Tasks rejected as Busy or
+        Saturated are retried up to BUSY_RETRIES times with jittered backoff, each time
+        on a freshly selected provider. The Future fails with TaskFailedError
+        when the task fails or stays rejected, ServiceUnavailable when no
+        provider is online, and TimeoutError after `timeout` seconds (the task
+        is then cancelled on the provider, as it is when the Future is cancelled).
+        """
+        return asyncio.ensure_future(self._submit(service_name, operation, parameters or {}, timeout, key, on_update))
+
+    async def _submit(self, service_name, operation, parameters, timeout, key, on_update):
+        delay = BUSY_RETRY_DELAY_SEC
+        for attempt in range(BUSY_RETRIES + 1):
+            service_info = self.repository.select_service(service_name, operation, self.strategy, key)
+            if service_info is None:
+                raise ServiceUnavailable(f"No online provider of {service_name}.{operation}")
+            client = self.client_for(service_info)
+            task_id = str(uuid.uuid4())
+            assign_msg = build_message(MessageTypes.ASSIGN_TASK, {
+                "taskId": task_id,
+                "serviceName": service_name,
+                "operation": operation,
+                "taskParameters": parameters,
+                "callbackClientId": self.client_id
+            })
+            try:
+                reply = await asyncio.wrap_future(client.submit_task(assign_msg, on_update, timeout))
+            except asyncio.CancelledError:
+                self._cancel_remote(client, task_id)
+                raise
+            if reply.get("type") == MessageTypes.TASK_RESULT:
+                return reply
+            if reply.get("reason") not in RETRYABLE_REJECTIONS or attempt == BUSY_RETRIES:
+                raise TaskFailedError(reply)
+            # Jittered so tasks rejected together do not all retry at the same moment
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, BUSY_RETRY_MAX_DELAY_SEC)
+
+    def _cancel_remote(self, client, task_id):
+        # Best effort: the caller no longer wants the result, so free the provider's worker
+        cancel = asyncio.ensure_future(client.send_message_async(
+            build_message(MessageTypes.CANCEL_TASK, {"taskId": task_id})))
+        cancel.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def submit_many(self, service_name, operation, parameter_list, concurrency=DEFAULT_SUBMIT_CONCURRENCY,
+                          timeout=None, return_exceptions=False):
+        """
+        Run one task per entry of `parameter_list` with at most `concurrency`
+        in flight and return their TaskResult messages in order. Like
+        asyncio.gather, the first failure is raised unless `return_exceptions`
+        puts the exceptions in the list instead; the tasks still outstanding
+        are then cancelled, on their providers too.
+        """
+        window = asyncio.Semaphore(concurrency)
+
+        async def run(parameters):
+            async with window:
+                return await self.submit(service_name, operation, parameters, timeout)
+
+        tasks = [asyncio.ensure_future(run(parameters)) for parameters in parameter_list]
+        try:
+            return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+        except BaseException:
+            # gather leaves the others running; nobody would collect their results
+            for task in tasks:
+                task.cancel()
+            raise
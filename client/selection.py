@@ -0,0 +1,108 @@
+# Provider selection strategies used by ServiceRepository.select_service
+import bisect
+import hashlib
+import random
+import threading
+
+
+def service_load(svc):
+    """Load reported in a service's advertisement, 0-100"""
+    try:
+        return float(svc.get("load") or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class SelectionStrategy:
+    """Picks one service out of a non-empty list of candidates"""
+
+    def select(self, candidates, key=None):
+        raise NotImplementedError
+
+
+class LeastLoadStrategy(SelectionStrategy):
+    def select(self, candidates, key=None):
+        return min(candidates, key=service_load)
+
+
+class PowerOfTwoChoicesStrategy(SelectionStrategy):
+    """Compare two random candidates; spreads load without herding on one provider"""
+
+    def select(self, candidates, key=None):
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if service_load(first) <= service_load(second) else second
+
+
+class WeightedRoundRobinStrategy(SelectionStrategy):
+    """Smooth weighted round-robin, weighting each provider by its spare capacity"""
+
+    def __init__(self):
+        self.current = {}  # serviceId -> current weight
+        self.lock = threading.Lock()
+
+    def select(self, candidates, key=None):
+        with self.lock:
+            total = 0.0
+            best = None
+            for svc in candidates:
+                weight = max(100.0 - service_load(svc), 1.0)
+                sid = svc["serviceId"]
+                self.current[sid] = self.current.get(sid, 0.0) + weight
+                total += weight
+                if best is None or self.current[sid] > self.current[best["serviceId"]]:
+                    best = svc
+            self.current[best["serviceId"]] -= total
+            # Forget providers that are no longer candidates
+            if len(self.current) > 2 * len(candidates):
+                live = {svc["serviceId"] for svc in candidates}
+                self.current = {sid: w for sid, w in self.current.items() if sid in live}
+            return best
+
+
+class ConsistentHashStrategy(SelectionStrategy):
+    """
+    Map a task key onto a hash ring of providers, so the same key keeps going
+    to the same provider and only keys of a departed provider move. Falls back
+    to least-load when no key is given.
+    """
+
+    def __init__(self, replicas=64):
+        self.replicas = replicas
+        self.rings = {}  # frozenset of serviceIds -> (sorted hashes, serviceIds)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def _ring(self, service_ids):
+        members = frozenset(service_ids)
+        with self.lock:
+            ring = self.rings.get(members)
+            if ring is None:
+                points = sorted(
+                    (self._hash(f"{sid}#{i}"), sid) for sid in members for i in range(self.replicas)
+                )
+                ring = ([h for h, _ in points], [sid for _, sid in points])
+                if len(self.rings) > 32:
+                    self.rings.clear()
+                self.rings[members] = ring
+            return ring
+
+    def select(self, candidates, key=None):
+        if key is None:
+            return LeastLoadStrategy().select(candidates)
+        by_id = {svc["serviceId"]: svc for svc in candidates}
+        hashes, service_ids = self._ring(by_id)
+        index = bisect.bisect(hashes, self._hash(str(key))) % len(hashes)
+        return by_id[service_ids[index]]
+
+
+STRATEGIES = {
+    "least-load": LeastLoadStrategy,
+    "power-of-two": PowerOfTwoChoicesStrategy,
+    "weighted-round-robin": WeightedRoundRobinStrategy,
+    "consistent-hash": ConsistentHashStrategy
+}
@@ -1,8 +1,6 @@
 import sys
-import threading
-import time
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QLabel, QTreeWidget, QTreeWidgetItem, QPushButton, QDialog, QFormLayout, QLineEdit, QDialogButtonBox, QTextEdit, QCheckBox, QScrollArea, QFrame, QSpinBox, QDoubleSpinBox
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtWidgets import QHeaderView
 from client.discovery_client import ClientDiscovery
 from client.service_repository import ServiceRepository
@@ -87,6 +85,11 @@ class ServiceSettingsDialog(QDialog):
         self._on_send_callback = callback
 
 class ServiceBrowser(QWidget):
+    # Emitted from the client pool thread when a provider pushes a final task message
+    task_finished = pyqtSignal(object, object)
+    # Emitted from discovery/expiry threads when the repository changes
+    services_changed = pyqtSignal()
+
     def __init__(self, repository, discovery):
         super().__init__()
         self.repository = repository
@@ -103,39 +106,24 @@ class ServiceBrowser(QWidget):
         self.refresh_btn.clicked.connect(self.manual_refresh)
         self.layout.addWidget(self.refresh_btn)
         self.setLayout(self.layout)
-        self.update_thread = threading.Thread(target=self.periodic_update, daemon=True)
-        self.update_thread.start()
+        # Redraw on repository change events instead of rescanning on a timer
+        self.services_changed.connect(self.update_tree)
+        self.repository.add_listener(lambda event, svc: self.services_changed.emit())
+        self.update_tree()
         self.tree.itemDoubleClicked.connect(self.on_item_double_clicked)
+        self.task_finished.connect(self._on_task_finished)
 
     def manual_refresh(self):
         self.discovery.send_discovery_request()
         self.update_tree()
 
-    def periodic_update(self):
-        while True:
-            self.update_tree()
-            time.sleep(5)
-
     def update_tree(self):
-        services = self.repository.get_services()
-        # Only update if there are changes
-        # Include capability statuses in the snapshot for more granular change detection
-        new_snapshot = [
-            (
-            svc.get("serviceId"),
-            svc.get("status"),
-            svc.get("load"),
-            str(svc.get("capabilities")),
-            tuple(
-                (cap_key, cap.get("status", "Unknown"))
-                for cap_key, cap in svc.get("capabilities", {}).items()
-            )
-            )
-            for svc in services
-        ]
-        if hasattr(self, '_last_snapshot') and self._last_snapshot == new_snapshot:
+        # The repository bumps its version on any added, removed or changed service
+        snapshot = self.repository.snapshot
+        if getattr(self, '_last_version', None) == snapshot.version:
             return
-        self._last_snapshot = new_snapshot
+        self._last_version = snapshot.version
+        services = snapshot.all
         self.tree.clear()
         for svc in services:
             provider_item = QTreeWidgetItem([
@@ -172,15 +160,16 @@ class ServiceBrowser(QWidget):
         task_id = str(uuid.uuid4())
         self.client = ServiceWebSocketClient(endpoint)
 
-        self._send_assign_task_message(svc, cap_key, params, task_id)
-
-        # Start a timer to check the result and status every 1s in a background thread
-        def poll_result():
-            self._check_for_result(svc, task_id, dialog)
+        # The provider pushes the result over the same connection; no polling needed
+        future = self._send_assign_task_message(svc, cap_key, params, task_id)
+        future.add_done_callback(lambda f: self.task_finished.emit(dialog, f))
 
-        self.timer = QTimer(dialog)
-        self.timer.timeout.connect(poll_result)
-        self.timer.start(2000)
+    def _on_task_finished(self, dialog, future):
+        try:
+            response = future.result()
+            dialog.set_result(str(response) if response else "No response received.")
+        except Exception as e:
+            dialog.set_result(f"Error: {e}")
 
     def _get_ws_endpoint(self, svc):
         endpoint = svc.get("endpoint")
@@ -201,52 +190,7 @@ class ServiceBrowser(QWidget):
             }
         )
 
-        # Send AssignTask
-        self.client.send_message(assign_msg)
-
-    def _check_for_result(self, svc, task_id, dialog):
-        try:
-            result = self._send_get_status_message(svc, task_id)
-            if result == "Done":
-                response = self._send_get_result_message(svc, task_id)
-
-                if response:
-                    dialog.set_result(str(response))
-                else:
-                    dialog.set_result("No response received.")
-
-                self.timer.stop()
-
-        except Exception as e:
-            dialog.set_result(f"Error: {e}")
-
-    def _send_get_status_message(self, svc, task_id):
-        status_msg = build_message(
-            "GetStatus",
-            {
-                "serviceId": svc.get("serviceId"),
-                "serviceName": svc.get("serviceName"),
-                "taskId": task_id
-            }
-        )
-
-        response = self.client.send_message(status_msg)
-        if isinstance(response, dict):
-            return response.get("taskStatus")
-        
-        return None
-
-    def _send_get_result_message(self, svc, task_id):
-        result_msg = build_message(
-            "GetResult",
-            {
-                "serviceId": svc.get("serviceId"),
-                "serviceName": svc.get("serviceName"),
-                "taskId": task_id
-            }
-        )
-
-        # Send GetResult and return the received result
-        return self.client.send_message(result_msg)
+        # Send AssignTask and return a future for the pushed TaskResult
+        return self.client.submit_task(assign_msg)
 
 
@@ -1,28 +1,273 @@
 # Service Repository for discovered services
+import heapq
 import threading
 import time
+from types import MappingProxyType
 from typing import Dict, Any
+from client.selection import STRATEGIES, PowerOfTwoChoicesStrategy
+from shared.discovery import HEARTBEAT_INTERVAL_SEC, SERVICE_EXPIRY_MULTIPLIER, merge_advertisement
+
+DEFAULT_SERVICE_EXPIRY_SEC = HEARTBEAT_INTERVAL_SEC * SERVICE_EXPIRY_MULTIPLIER
+
+# Change events passed to repository listeners
+SERVICE_ADDED   = "added"
+SERVICE_UPDATED = "updated"
+SERVICE_REMOVED = "removed"
+
+
+def capability_keys(service_info):
+    """Capability names of a service; capabilities are a dict or a list of {"key": ...}"""
+    capabilities = service_info.get('capabilities') or {}
+    if isinstance(capabilities, dict):
+        return list(capabilities.keys())
+    return [cap.get('key') for cap in capabilities if isinstance(cap, dict) and cap.get('key')]
+
+
+def capability_status(service_info, operation):
+    """Advertised status of one capability of a service (Ready/Busy/Saturated), or None"""
+    capabilities = service_info.get('capabilities') or {}
+    if isinstance(capabilities, dict):
+        return (capabilities.get(operation) or {}).get('status')
+    for cap in capabilities:
+        if isinstance(cap, dict) and cap.get('key') == operation:
+            return cap.get('status')
+    return None
+
+
+# Advertisement fields that change on every packet without changing the service
+VOLATILE_FIELDS = ('timestamp', 'lastSeenTimestamp', 'respondsToClientId')
+
+
+def _content(service_info):
+    return {k: v for k, v in service_info.items() if k not in VOLATILE_FIELDS}
+
+
+class RepositorySnapshot:
+    """
+    Immutable view of the repository at one version. Writers publish a new
+    snapshot instead of mutating this one, so readers never take a lock.
+    """
+    __slots__ = ('version', 'services', 'all', 'by_name', 'online_by_name', 'by_capability')
+
+    def __init__(self, version=0, services=None, by_name=None, online_by_name=None, by_capability=None):
+        self.version = version
+        self.services = MappingProxyType(services or {})  # serviceId -> service info
+        self.all = tuple(self.services.values())
+        self.by_name = MappingProxyType(by_name or {})  # serviceName -> (service info, ...)
+        self.online_by_name = MappingProxyType(online_by_name or {})
+        self.by_capability = MappingProxyType(by_capability or {})  # capability -> frozenset(serviceId)
+
 
 class ServiceRepository:
-    def __init__(self):
-        self.services = {}  # serviceId -> service info dict
-        self.lock = threading.Lock()
+    def __init__(self, strategy=None):
+        self.snapshot = RepositorySnapshot()
+        self.lock = threading.Lock()  # serializes writers only
+        self._strategies = {}  # name -> strategy instance
+        self.strategy = self._resolve_strategy(strategy) or PowerOfTwoChoicesStrategy()
+        self.listeners = []
+        # Expiry heap of (deadline, serviceId), one item per service. A service seen
+        # again since its item was pushed is rescheduled when the item comes due.
+        self.expiry_seconds = DEFAULT_SERVICE_EXPIRY_SEC
+        self.expiry_heap = []
+        self.scheduled = set()  # serviceIds with an item in expiry_heap
+        self.expiry_cond = threading.Condition(self.lock)
+        self.sweeper_running = False
+
+    @property
+    def version(self):
+        """Increases whenever a service is added, removed or changes content"""
+        return self.snapshot.version
+
+    @property
+    def services(self):
+        return self.snapshot.services
+
+    def changed_since(self, version):
+        return self.snapshot.version != version
+
+    def add_listener(self, callback):
+        """Call `callback(event, service_info)` when a service is added, updated or removed"""
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def _notify(self, events):
+        for event, service_info in events:
+            for callback in list(self.listeners):
+                try:
+                    callback(event, service_info)
+                except Exception as e:
+                    print(f"Repository listener error: {e}")
 
     def update_service(self, service_info: Dict[str, Any]):
         with self.lock:
             sid = service_info['serviceId']
-            service_info['lastSeenTimestamp'] = time.time()
-            self.services[sid] = service_info
+            now = time.time()
+            current = self.snapshot.services.get(sid)
+            if current is not None and _content(current) == _content(service_info):
+                # Same advertisement again: refresh liveness, keep the version
+                current['lastSeenTimestamp'] = now
+                return
+            service_info['lastSeenTimestamp'] = now
+            self._commit({sid: service_info})
+            if sid not in self.scheduled:
+                if not self.expiry_heap:
+                    self.expiry_cond.notify()
+                heapq.heappush(self.expiry_heap, (now + self.expiry_seconds, sid))
+                self.scheduled.add(sid)
+        self._notify([(SERVICE_UPDATED if current else SERVICE_ADDED, service_info)])
+
+    def apply_delta(self, delta):
+        """
+        Merge a delta (or pointer) advertisement into the service it refers to.
+        Returns False when the service is unknown or holds another
+        schemaVersion; the full advertisement is needed then.
+        """
+        current = self.snapshot.services.get(delta.get('serviceId'))
+        if current is None or current.get('schemaVersion') != delta.get('schemaVersion'):
+            return False
+        self.update_service(merge_advertisement(current, delta))
+        return True
+
+    def known_schemas(self):
+        """{serviceId: schemaVersion} of the services whose full advertisement is cached"""
+        return {sid: s['schemaVersion'] for sid, s in self.snapshot.services.items() if s.get('schemaVersion')}
+
+    def _commit(self, updates):
+        """Publish a new snapshot applying {serviceId: service info or None to remove}"""
+        snap = self.snapshot
+        services = dict(snap.services)
+        names, caps = set(), set()
+        for sid, info in updates.items():
+            for svc in (services.get(sid), info):
+                if svc is not None:
+                    names.add(svc.get('serviceName'))
+                    caps.update(capability_keys(svc))
+            if info is None:
+                services.pop(sid, None)
+            else:
+                services[sid] = info
+
+        added = [info for info in updates.values() if info is not None]
+        by_name = dict(snap.by_name)
+        online_by_name = dict(snap.online_by_name)
+        for name in names:
+            members = tuple(s for s in snap.by_name.get(name, ()) if s['serviceId'] not in updates)
+            members += tuple(info for info in added if info.get('serviceName') == name)
+            if members:
+                by_name[name] = members
+                online_by_name[name] = tuple(s for s in members if s.get('status') == 'Online')
+            else:
+                by_name.pop(name, None)
+                online_by_name.pop(name, None)
+
+        by_capability = dict(snap.by_capability)
+        for cap in caps:
+            providers = snap.by_capability.get(cap, frozenset()).difference(updates)
+            providers = providers.union(info['serviceId'] for info in added if cap in capability_keys(info))
+            if providers:
+                by_capability[cap] = providers
+            else:
+                by_capability.pop(cap, None)
+
+        self.snapshot = RepositorySnapshot(snap.version + 1, services, by_name, online_by_name, by_capability)
 
     def get_services(self, service_name=None):
-        with self.lock:
-            if service_name:
-                return [s for s in self.services.values() if s['serviceName'] == service_name and s['status'] == 'Online']
-            return list(self.services.values())
+        """Services from the current snapshot; the returned tuple must not be modified"""
+        snap = self.snapshot
+        if service_name:
+            return snap.online_by_name.get(service_name, ())
+        return snap.all
+
+    def get_candidates(self, service_name, operation=None):
+        """Online services named `service_name`, optionally offering `operation`"""
+        snap = self.snapshot
+        online = snap.online_by_name.get(service_name, ())
+        if operation is None:
+            return online
+        providers = snap.by_capability.get(operation, frozenset())
+        return [s for s in online if s['serviceId'] in providers]
+
+    def select_service(self, service_name, operation=None, strategy=None, key=None):
+        """
+        Pick one provider of `service_name` (and `operation`) using a selection
+        strategy: a SelectionStrategy instance or one of the names in
+        client.selection.STRATEGIES. `key` is the task key used by
+        consistent-hash. Returns None when no provider is available.
+        """
+        candidates = self.get_candidates(service_name, operation)
+        if not candidates:
+            return None
+        if operation is not None:
+            # Skip providers that would reject the task, unless all of them would
+            available = [s for s in candidates if capability_status(s, operation) != "Saturated"]
+            candidates = available or candidates
+        return (self._resolve_strategy(strategy) or self.strategy).select(candidates, key)
+
+    def _resolve_strategy(self, strategy):
+        if not isinstance(strategy, str):
+            return strategy
+        # Named strategies keep their state (round-robin weights, hash rings) across calls
+        if strategy not in self._strategies:
+            self._strategies[strategy] = STRATEGIES[strategy]()
+        return self._strategies[strategy]
 
     def expire_services(self, expiry_seconds):
+        """Remove every service not seen for `expiry_seconds` (full scan)"""
         now = time.time()
         with self.lock:
-            expired = [sid for sid, s in self.services.items() if now - s['lastSeenTimestamp'] > expiry_seconds]
-            for sid in expired:
-                del self.services[sid]
+            expired = {sid: s for sid, s in self.snapshot.services.items() if now - s['lastSeenTimestamp'] > expiry_seconds}
+            if expired:
+                self._commit({sid: None for sid in expired})
+        self._notify([(SERVICE_REMOVED, s) for s in expired.values()])
+
+    def _pop_expired(self, now):
+        """Remove services whose deadline passed; caller holds the lock"""
+        expired = []
+        services = self.snapshot.services
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            _, sid = heapq.heappop(self.expiry_heap)
+            svc = services.get(sid)
+            if svc is None:
+                self.scheduled.discard(sid)
+                continue
+            deadline = svc['lastSeenTimestamp'] + self.expiry_seconds
+            if deadline > now:
+                heapq.heappush(self.expiry_heap, (deadline, sid))
+            else:
+                self.scheduled.discard(sid)
+                expired.append(svc)
+        if expired:
+            self._commit({svc['serviceId']: None for svc in expired})
+        return expired
+
+    def _sweep(self):
+        while True:
+            with self.lock:
+                if not self.sweeper_running:
+                    return
+                expired = self._pop_expired(time.time())
+                if not expired:
+                    timeout = self.expiry_heap[0][0] - time.time() if self.expiry_heap else None
+                    self.expiry_cond.wait(timeout)
+            self._notify([(SERVICE_REMOVED, svc) for svc in expired])
+
+    def start_expiry_sweeper(self, expiry_seconds=DEFAULT_SERVICE_EXPIRY_SEC):
+        """Remove services not seen for `expiry_seconds` from a background thread"""
+        with self.lock:
+            self.expiry_seconds = expiry_seconds
+            if self.sweeper_running:
+                return
+            self.sweeper_running = True
+            # Services added before the sweeper started
+            self.expiry_heap = [(s['lastSeenTimestamp'] + expiry_seconds, sid) for sid, s in self.snapshot.services.items()]
+            heapq.heapify(self.expiry_heap)
+            self.scheduled = set(self.snapshot.services)
+        threading.Thread(target=self._sweep, name="service-expiry", daemon=True).start()
+
+    def stop_expiry_sweeper(self):
+        with self.lock:
+            self.sweeper_running = False
+            self.expiry_cond.notify()
@@ -1,27 +1,176 @@
 # WebSocket client for connecting to service providers (WSS)
 import asyncio
+import concurrent.futures
 import ssl
-import websockets
-import json
-from shared.messages import build_message
+from client.connection_pool import get_default_pool, UNWATCHED_TASK_STATUSES
+from shared.messages import build_message, MessageTypes, DEFAULT_STREAM_WINDOW
+
+FINAL_TASK_MESSAGES = (MessageTypes.TASK_RESULT, MessageTypes.TASK_FAILED)
+
 
 class ServiceWebSocketClient:
-    def __init__(self, endpoint, ssl_cert=None):
+    def __init__(self, endpoint, ssl_cert=None, pool=None):
         self.endpoint = endpoint
+        self.pool = pool or get_default_pool()
+        self.ssl_context = None
+        if ssl_cert and endpoint.startswith("wss://"):
+            self.ssl_context = ssl.create_default_context(cafile=ssl_cert)
+
+    async def send_message_async(self, message, timeout=None):
+        """Send a message over a pooled connection and await the provider's response"""
+        return await self.pool.request_async(self.endpoint, message, timeout, self.ssl_context)
+
+    def send_message(self, message, timeout=None):
+        """Blocking variant of send_message_async for non-async callers"""
+        return self.pool.request(self.endpoint, message, timeout, self.ssl_context).result()
+
+    def get_status(self, task_id, timeout=None):
+        """Status reply for a task; concurrent identical calls share one request"""
+        return self.send_message(build_message(MessageTypes.GET_STATUS, {"taskId": task_id}), timeout)
+
+    def get_result(self, task_id, timeout=None):
+        """
+        TaskResult/TaskFailed of a task, or the "Result not ready" reply. Final
+        results are cached by the pool, so repeated calls after the task
+        finished do not reach the provider.
+        """
+        return self.send_message(build_message(MessageTypes.GET_RESULT, {"taskId": task_id}), timeout)
+
+    def stream_result(self, task_id, window=DEFAULT_STREAM_WINDOW, timeout=None):
+        """
+        Async iterator over the chunks of a streamed task result (a TaskResult
+        with "streamed": True). At most `window` chunks are in flight, so memory
+        stays flat regardless of the result size. Raises TaskStreamError when
+        the provider cannot deliver the stream.
+        """
+        message = build_message(MessageTypes.GET_RESULT_STREAM, {"taskId": task_id})
+        return self.pool.stream(self.endpoint, message, window, timeout, self.ssl_context)
+
+    def watch_task(self, task_id, on_update=None):
+        """
+        Return a concurrent.futures.Future resolved with the TaskResult or TaskFailed
+        message the provider pushes for `task_id`. Intermediate TaskStatusUpdate
+        messages are passed to `on_update`, which runs on the pool's event loop.
+        The Future fails with ConnectionError if the connection the task's
+        updates arrive on closes first.
+        """
+        future = concurrent.futures.Future()
+
+        def listener(message):
+            if isinstance(message, Exception):
+                # The connection carrying the task's updates closed
+                if not future.done():
+                    future.set_exception(message)
+            elif message.get("type") in FINAL_TASK_MESSAGES:
+                self.pool.remove_task_listener(task_id, listener)
+                if not future.done():
+                    future.set_result(message)
+            elif on_update:
+                on_update(message)
+
+        self.pool.add_task_listener(task_id, listener)
+        future.add_done_callback(lambda _: self.pool.remove_task_listener(task_id, listener))
+        return future
+
+    def submit_task(self, assign_msg, on_update=None, timeout=None):
+        """
+        Send an AssignTask without blocking and return a Future for its pushed
+        result. With `timeout` (seconds) the provider gets the same deadline
+        as timeoutMs; if no result arrives in time the task is cancelled and
+        the Future fails with concurrent.futures.TimeoutError.
+        """
+        task_id = assign_msg["payload"]["taskId"]
+        future = self.watch_task(task_id, on_update)
+        if timeout is not None:
+            assign_msg["payload"].setdefault("timeoutMs", int(timeout * 1000))
+            self._cancel_on_timeout(task_id, future, timeout)
+        self._send_linked(assign_msg, future)
+        return future
+
+    def cancel_task(self, task_id, timeout=None):
+        """Cancel a task; returns the provider's Status reply ("Cancelled" unless it had finished)"""
+        return self.send_message(build_message(MessageTypes.CANCEL_TASK, {"taskId": task_id}), timeout)
+
+    def _cancel_on_timeout(self, task_id, future, timeout):
+        def expire():
+            # Runs on the pool's loop, like the listener resolving the Future
+            if future.done():
+                return
+            future.set_exception(concurrent.futures.TimeoutError(f"Task {task_id} timed out after {timeout}s"))
+            # Reclaim the provider's worker right away instead of at its own deadline
+            cancel = asyncio.ensure_future(self.send_message_async(
+                build_message(MessageTypes.CANCEL_TASK, {"taskId": task_id})))
+            cancel.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+        def arm():
+            handle = self.pool.loop.call_later(timeout, expire)
+            future.add_done_callback(lambda _: self.pool.loop.call_soon_threadsafe(handle.cancel))
+
+        self.pool.loop.call_soon_threadsafe(arm)
+
+    def submit_task_batch(self, tasks, on_update=None):
+        """
+        Assign many tasks with one AssignTaskBatch message. `tasks` are AssignTask
+        payloads (taskId, operation, taskParameters, ...). Returns one Future per
+        task, resolved like submit_task's.
+        """
+        futures = [self.watch_task(task["taskId"], on_update) for task in tasks]
+        by_task = {task["taskId"]: future for task, future in zip(tasks, futures)}
+
+        def on_reply(reply):
+            if reply.exception():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(reply.exception())
+                return
+            response = reply.result()
+            if response.get("type") != MessageTypes.STATUS_BATCH:
+                error = RuntimeError(response.get("payload", {}).get("errorMessage", "Batch rejected"))
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+                return
+            for entry in response.get("tasks", []):
+                future = by_task.get(entry["taskId"])
+                if entry.get("taskStatus") == "Rejected" and future is not None and not future.done():
+                    future.set_result(entry)
+
+        message = build_message(MessageTypes.ASSIGN_TASK_BATCH, {"tasks": tasks})
+        self.pool.request(self.endpoint, message, None, self.ssl_context).add_done_callback(on_reply)
+        return futures
+
+    def assign_task_batch(self, tasks, subscribe=False, timeout=None):
+        """
+        Assign many tasks and return the StatusBatch reply. Without `subscribe`
+        no results are pushed; collect them with get_result_batch().
+        """
+        return self.send_message(build_message(MessageTypes.ASSIGN_TASK_BATCH,
+                                               {"tasks": tasks, "subscribe": subscribe}), timeout)
+
+    def get_status_batch(self, task_ids, timeout=None):
+        """StatusBatch reply with one {"taskId", "taskStatus"} entry per task"""
+        return self.send_message(build_message(MessageTypes.GET_STATUS_BATCH, {"taskIds": list(task_ids)}), timeout)
+
+    def get_result_batch(self, task_ids, timeout=None):
+        """TaskResultBatch reply: "results" of finished tasks and the "notReady" taskIds"""
+        return self.send_message(build_message(MessageTypes.GET_RESULT_BATCH, {"taskIds": list(task_ids)}), timeout)
+
+    def subscribe_task(self, task_id, on_update=None):
+        """Follow a task assigned by another connection or client"""
+        future = self.watch_task(task_id, on_update)
+        self._send_linked(build_message(MessageTypes.SUBSCRIBE_TASK, {"taskId": task_id}), future)
+        return future
+
+    def _send_linked(self, message, future):
+        # Fail the watcher if the request never reaches the provider, and finish
+        # it with the reply itself when the provider rejects the task or does
+        # not know it, as nothing will be pushed for it
+        def on_reply(reply):
+            if future.done():
+                return
+            if reply.exception():
+                future.set_exception(reply.exception())
+            elif reply.result().get("taskStatus") in UNWATCHED_TASK_STATUSES:
+                future.set_result(reply.result())
 
-    async def send_message_async(self, message):
-        async with websockets.connect(self.endpoint) as websocket:
-            await websocket.send(json.dumps(message))
-            async for response in websocket:
-                yield json.loads(response)
-
-    def send_message(self, message):
-        async def run():
-            status_result = self.send_message_async(message)
-            async for resp in status_result:
-                return resp
-        
-        loop = asyncio.new_event_loop()
-        resp = loop.run_until_complete(run())
-
-        return resp
\ No newline at end of file
+        self.pool.request(self.endpoint, message, None, self.ssl_context).add_done_callback(on_reply)
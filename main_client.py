@@ -9,6 +9,7 @@ from PyQt5.QtWidgets import QApplication
 CLIENT_ID = str(uuid.uuid4())
 
 repository = ServiceRepository()
+repository.start_expiry_sweeper()
 discovery = ClientDiscovery(CLIENT_ID, repository)
 discovery.start()
 
@@ -20,4 +21,5 @@ try:
     sys.exit(app.exec_())
 except KeyboardInterrupt:
     discovery.stop()
+    repository.stop_expiry_sweeper()
     print("Client stopped.")
@@ -13,6 +13,8 @@ PORT = random.randint(8080, 8090)
 CAPABILITIES = {
     "resizeImage" : {
         "status": "Ready",
+        "maxConcurrency": 4,
+        "cacheResults": True,
         "settings": [
             {"string": "inputPath"},
             {"string": "output"}, 
@@ -29,6 +31,7 @@ CAPABILITIES = {
     },
     "convertFormat" : {
         "status": "Ready",
+        "cacheResults": True,
         "settings": [
             {"float": "format"}
         ]
@@ -51,10 +54,8 @@ class ServiceProviderBEBuilder(ServiceProviderBase):
             "processedByServiceId": self.service_info["serviceId"],
             "executionDurationMs": 1234
         }
-        # Store result and mark as done
-        self.task_store[task_id]["result"] = base_result
-        self.task_store[task_id]["status"] = "Done"
-        CAPABILITIES["getChangeLists"]["status"] = "Ready"
+        # Store result, mark as done and push it to the client
+        self.complete_task(task_id, base_result)
 
     def apply_filter(self, task_id, parameters, base_result):
         change_list_number = parameters.get("changeListNumber", 0)
@@ -68,10 +69,8 @@ class ServiceProviderBEBuilder(ServiceProviderBase):
             "processedByServiceId": self.service_info["serviceId"],
             "executionDurationMs": 1234
         }
-        # Store result and mark as done
-        self.task_store[task_id]["result"] = base_result
-        self.task_store[task_id]["status"] = "Done"
-        CAPABILITIES["runBuildOnChangeList"]["status"] = "Ready"
+        # Store result, mark as done and push it to the client
+        self.complete_task(task_id, base_result)
 
     def convert_format(self, task_id, parameters, base_result):
         be_file_output_path = parameters.get("BEFileOutputPath", "output/")
@@ -83,23 +82,17 @@ class ServiceProviderBEBuilder(ServiceProviderBase):
             "processedByServiceId": self.service_info["serviceId"],
             "executionDurationMs": 1234
         }
-        # Store result and mark as done
-        self.task_store[task_id]["result"] = base_result
-        self.task_store[task_id]["status"] = "Done"
-        CAPABILITIES["runBuildOnLatest"]["status"] = "Ready"
+        # Store result, mark as done and push it to the client
+        self.complete_task(task_id, base_result)
 
     def handle_assign_task(self, task_id, operation, parameters, base_result):
-        import threading
-
+        # Runs on the provider's bounded worker pool
         if operation == "resizeImage":
-            thread = threading.Thread(target=self.resize_image, args=(task_id, parameters, base_result))
-            thread.start()
+            self.resize_image(task_id, parameters, base_result)
         elif operation == "applyFilter":
-            thread = threading.Thread(target=self.apply_filter, args=(task_id, parameters, base_result))
-            thread.start()
+            self.apply_filter(task_id, parameters, base_result)
         elif operation == "convertFormat":
-            thread = threading.Thread(target=self.convert_format, args=(task_id, parameters, base_result))
-            thread.start()
+            self.convert_format(task_id, parameters, base_result)
 
 if __name__ == "__main__":
     ServiceProviderBEBuilder().run()
\ No newline at end of file
@@ -0,0 +1,93 @@
+# Per-capability concurrency limits and the capability statuses advertised to clients
+import threading
+from collections import deque
+
+CAPABILITY_READY     = "Ready"      # a task would start right away
+CAPABILITY_BUSY      = "Busy"       # a task would wait for a slot
+CAPABILITY_SATURATED = "Saturated"  # a task would be rejected
+
+
+class CapabilitySaturated(Exception):
+    """Raised when every slot of a capability is in use and its wait queue is full"""
+
+
+def capability_state(free_slots, waiting, max_waiting):
+    """Advertised status of a capability from its free slots and waiting tasks"""
+    if free_slots > 0:
+        return CAPABILITY_READY
+    if waiting >= max_waiting:
+        return CAPABILITY_SATURATED
+    return CAPABILITY_BUSY
+
+
+class CapabilityLimiter:
+    """
+    Runs at most "maxConcurrency" tasks at once of each capability declaring
+    it. Further tasks wait in a FIFO of up to "maxQueue" entries (default
+    `max_queue_size`) and start as running ones finish; beyond that admit()
+    raises CapabilitySaturated. Capabilities without a limit are not tracked.
+
+    start callables take `deferred` (False when called from admit()) and
+    return whether the task took the slot; a task cancelled while waiting
+    returns False and its slot passes to the next one.
+    """
+
+    def __init__(self, capabilities, max_queue_size):
+        self.limits = {}
+        self.max_waiting = {}
+        for key, cap in (capabilities or {}).items():
+            if cap.get("maxConcurrency"):
+                self.limits[key] = int(cap["maxConcurrency"])
+                self.max_waiting[key] = int(cap.get("maxQueue", max_queue_size))
+        self.running = {key: 0 for key in self.limits}
+        self.waiting = {key: deque() for key in self.limits}
+        self.lock = threading.Lock()
+
+    def __contains__(self, operation):
+        return operation in self.limits
+
+    def admit(self, operation, start):
+        """Start a task now if a slot is free, or queue it; returns False when queued"""
+        if operation not in self.limits:
+            start(False)
+            return True
+        with self.lock:
+            if self.running[operation] >= self.limits[operation]:
+                if len(self.waiting[operation]) >= self.max_waiting[operation]:
+                    raise CapabilitySaturated(f"{operation}: {self.limits[operation]} running, "
+                                              f"{len(self.waiting[operation])} waiting")
+                self.waiting[operation].append(start)
+                return False
+            self.running[operation] += 1
+        try:
+            started = start(False)
+        except Exception:
+            self.release(operation)
+            raise
+        if not started:
+            self.release(operation)
+        return True
+
+    def release(self, operation):
+        """Free the slot of a finished task, handing it to the next waiting task"""
+        while operation in self.limits:
+            with self.lock:
+                if not self.waiting[operation]:
+                    self.running[operation] -= 1
+                    return
+                start = self.waiting[operation].popleft()
+            try:
+                if start(True):
+                    return
+            except Exception as e:
+                print(f"Could not start waiting {operation} task: {e}")
+
+    def waiting_count(self):
+        with self.lock:
+            return sum(len(tasks) for tasks in self.waiting.values())
+
+    def state(self, operation):
+        """(status, freeSlots) of a limited capability"""
+        with self.lock:
+            free_slots = max(0, self.limits[operation] - self.running[operation])
+            return capability_state(free_slots, len(self.waiting[operation]), self.max_waiting[operation]), free_slots
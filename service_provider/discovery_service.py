@@ -1,27 +1,53 @@
 # UDP Discovery for service provider with multi-provider support
+import asyncio
 import socket
-import json
 import threading
 import time
 import random
-from shared.discovery import UDP_SERVICE_DISCOVERY_PORT, HEARTBEAT_INTERVAL_SEC
+from shared.discovery import UDP_SERVICE_DISCOVERY_PORT, UDP_CLIENT_DISCOVERY_PORT, join_multicast_group, DiscoveryDatagramProtocol
+from shared.discovery import AdaptiveInterval, DISCOVERY_TRANSPORT_BROADCAST, get_discovery_targets
+from shared.discovery import SCHEMA_FIELDS, schema_version, capability_statuses, capability_free_slots
+from shared.discovery import MAX_DATAGRAM_SIZE, DISCOVERY_RECV_BUFFER_SIZE, encode_datagram, decode_datagram
 from shared.messages import MessageTypes
+from shared.metrics import MetricsRegistry
+
+# Load swings of this many points make a secondary heartbeat early (see _announced_state)
+LOAD_CHURN_STEP = 20
+
+# Discovery types counted by name in soa_discovery_packets_total; others share one label
+DISCOVERY_TYPES = frozenset((
+    MessageTypes.CLIENT_DISCOVERY_REQUEST, MessageTypes.SERVICE_ADVERTISEMENT,
+    MessageTypes.SERVICE_ADVERTISEMENT_BATCH, MessageTypes.PROVIDER_DISCOVERY_REQUEST,
+    MessageTypes.PROVIDER_DISCOVERY_RESPONSE, MessageTypes.PROVIDER_REGISTRATION,
+    MessageTypes.PROVIDER_NOTIFICATION, MessageTypes.PROVIDER_HEARTBEAT,
+    MessageTypes.PROVIDER_UNREGISTRATION))
 
 class ServiceDiscoveryBroadcaster:
-    def __init__(self, service_info):
+    def __init__(self, service_info, metrics=None):
         self.service_info = service_info
+        self.metrics = metrics or MetricsRegistry()
+        self.packets_total = self.metrics.counter(
+            "soa_discovery_packets_total", "Discovery datagrams, by direction and discovery type",
+            ["direction", "type"])
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self.running = False
         self.is_primary = False
         self.registered_providers = {}  # For primary provider: {provider_id: {info, last_heartbeat}}
         self.primary_provider_addr = None  # For secondary providers
+        self.transport = None  # Set when running on an event loop (start_async)
+        self.heartbeat_task = None
+        # Primaries announce to clients, secondaries heartbeat to the primary
+        self.heartbeat_timer = AdaptiveInterval()
+        self.wakeup = threading.Event()
         self.provider_id = f"provider_{int(time.time())}_{random.randint(1000, 9999)}"
 
         try:
             self.sock.bind(('0.0.0.0', UDP_SERVICE_DISCOVERY_PORT))
             self.is_primary = True
             print(f"Primary provider {self.provider_id} bound to discovery port")
+            # Accept requests from clients using the multicast transport as well
+            join_multicast_group(self.sock)
         except OSError as e:
             print(f"Could not bind to discovery port: {e}")
             print(f"Attempting to register as secondary provider {self.provider_id}")
@@ -36,15 +62,69 @@ class ServiceDiscoveryBroadcaster:
         # Try to find and register with primary provider
         self._find_and_register_with_primary()
 
-    def broadcast(self, target_addr=None):
-        msg = self.service_info.copy()
+    def broadcast(self, target_addr=None, known_schema=None, delta=False):
+        """
+        Advertise this service to `target_addr`. When the client already holds
+        the current schema (`known_schema` equals our schemaVersion), or
+        `delta` is set, only a delta is sent: the advertisement without
+        SCHEMA_FIELDS, plus capabilityStatus with the status of each
+        capability. A full advertisement too large for one datagram even
+        compressed is replaced by a pointer (descriptorRef) that clients
+        resolve with GetDescriptor.
+        """
+        msg, data = self._advertisement(self.service_info, self.provider_id, known_schema, delta)
+        self._send(msg, target_addr, data)
+
+    def _advertisement(self, service_info, provider_id, known_schema=None, delta=False):
+        """The advertisement of `service_info` and its encoded datagram"""
+        info = service_info.copy()
+        version = schema_version(info)
+        if delta or known_schema == version:
+            msg = self._partial_advertisement(info)
+            msg['delta'] = True
+        else:
+            msg = info
+        self._stamp_advertisement(msg, version, provider_id)
+        data = encode_datagram(msg)
+        if len(data) > MAX_DATAGRAM_SIZE:
+            msg = self._partial_advertisement(info)
+            msg['endpoint'] = info.get('endpoint')
+            msg['descriptorRef'] = True
+            self._stamp_advertisement(msg, version, provider_id)
+            data = encode_datagram(msg)
+        return msg, data
+
+    def _partial_advertisement(self, info):
+        msg = {key: value for key, value in info.items() if key not in SCHEMA_FIELDS}
+        msg['capabilityStatus'] = capability_statuses(info.get('capabilities'))
+        free_slots = capability_free_slots(info.get('capabilities'))
+        if free_slots:
+            msg['capabilitySlots'] = free_slots
+        return msg
+
+    def _stamp_advertisement(self, msg, version, provider_id):
+        msg['schemaVersion'] = version
         msg['discoveryType'] = MessageTypes.SERVICE_ADVERTISEMENT
-        msg['providerId'] = self.provider_id
+        msg['providerId'] = provider_id
         msg['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
 
-        # Use appropriate socket based on provider type
-        sock_to_use = self.sock if self.is_primary else self.secondary_sock
-        sock_to_use.sendto(json.dumps(msg).encode(), target_addr)
+    def _send(self, msg, addr, data=None):
+        """Send a discovery message from this provider's socket (primary or secondary)"""
+        if data is None:
+            data = encode_datagram(msg)
+        self.packets_total.labels("out", msg.get('discoveryType')).inc()
+        if self.transport is not None:
+            self.transport.sendto(data, addr)
+        else:
+            sock_to_use = self.sock if self.is_primary else self.secondary_sock
+            sock_to_use.sendto(data, addr)
+
+    def _count_received(self, msg):
+        # Datagrams come from anyone on the LAN: label unknown types with one
+        # value so they cannot grow the metric without bound
+        msg_type = msg.get('discoveryType')
+        known = isinstance(msg_type, str) and msg_type in DISCOVERY_TYPES
+        self.packets_total.labels("in", msg_type if known else "unknown").inc()
 
     def listen(self):
         """Listen for discovery messages - different behavior for primary vs secondary"""
@@ -59,148 +139,305 @@ class ServiceDiscoveryBroadcaster:
         """Primary provider listens for client requests and provider registrations"""
         while self.running:
             try:
-                data, sender_addr = self.sock.recvfrom(4096)
-                msg = json.loads(data.decode())
-                msg_type = msg.get('discoveryType')
-
-                if msg_type == MessageTypes.CLIENT_DISCOVERY_REQUEST:
-                    # Respond for self
-                    self.broadcast(target_addr=sender_addr)
-                    # Notify registered providers
-                    self._notify_registered_providers(sender_addr)
-
-                elif msg_type == MessageTypes.PROVIDER_DISCOVERY_REQUEST:
-                    # Respond to provider discovery request
-                    response = {
-                        'discoveryType': MessageTypes.PROVIDER_DISCOVERY_RESPONSE,
-                        'providerId': self.provider_id,
-                        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
-                    }
-                    self.sock.sendto(json.dumps(response).encode(), sender_addr)
-
-                elif msg_type == MessageTypes.PROVIDER_REGISTRATION:
-                    # Register a secondary provider
-                    provider_id = msg.get('providerId')
-                    if provider_id:
-                        self.registered_providers[provider_id] = {
-                            'info': msg.get('serviceInfo', {}),
-                            'addr': sender_addr,
-                            'last_heartbeat': time.time()
-                        }
-                        print(f"Registered provider {provider_id} from {sender_addr}")
-
-                elif msg_type == MessageTypes.PROVIDER_HEARTBEAT:
-                    # Update heartbeat for registered provider
-                    provider_id = msg.get('providerId')
-                    if provider_id in self.registered_providers:
-                        self.registered_providers[provider_id]['last_heartbeat'] = time.time()
-
+                data, sender_addr = self.sock.recvfrom(DISCOVERY_RECV_BUFFER_SIZE)
+                self.handle_primary_message(decode_datagram(data), sender_addr)
             except Exception as e:
                 if self.running:  # Only log if we're supposed to be running
                     print(f"Primary provider listen error: {e}")
-    
+
+    def handle_primary_message(self, msg, sender_addr):
+        """Handle one discovery message received by the primary provider"""
+        msg_type = msg.get('discoveryType')
+        self._count_received(msg)
+
+        if msg_type == MessageTypes.CLIENT_DISCOVERY_REQUEST:
+            known_schemas = msg.get('knownSchemas') or {}
+            # Respond for self and every registered provider whose service info we hold
+            advertisements, unknown = self._local_advertisements(known_schemas)
+            for batch, data in self._batches(advertisements):
+                self._send(batch, sender_addr, data)
+            # Registered providers without service info answer for themselves
+            if unknown:
+                self._notify_registered_providers(sender_addr, known_schemas, unknown)
+
+        elif msg_type == MessageTypes.PROVIDER_DISCOVERY_REQUEST:
+            # Respond to provider discovery request
+            response = {
+                'discoveryType': MessageTypes.PROVIDER_DISCOVERY_RESPONSE,
+                'providerId': self.provider_id,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+            }
+            self._send(response, sender_addr)
+
+        elif msg_type == MessageTypes.PROVIDER_REGISTRATION:
+            # Register a secondary provider
+            provider_id = msg.get('providerId')
+            if provider_id:
+                self.registered_providers[provider_id] = {
+                    'info': msg.get('serviceInfo', {}),
+                    'addr': sender_addr,
+                    'last_heartbeat': time.time()
+                }
+                print(f"Registered provider {provider_id} from {sender_addr}")
+
+        elif msg_type == MessageTypes.PROVIDER_HEARTBEAT:
+            # Update heartbeat for registered provider
+            provider_id = msg.get('providerId')
+            if provider_id in self.registered_providers:
+                provider = self.registered_providers[provider_id]
+                provider['last_heartbeat'] = time.time()
+                if msg.get('serviceInfo'):
+                    provider['info'] = msg['serviceInfo']
+            elif provider_id and msg.get('serviceInfo'):
+                # Heartbeat from a secondary that registered with a previous primary
+                self.registered_providers[provider_id] = {
+                    'info': msg['serviceInfo'],
+                    'addr': sender_addr,
+                    'last_heartbeat': time.time()
+                }
+                print(f"Registered provider {provider_id} from {sender_addr} (heartbeat)")
+
+        elif msg_type == MessageTypes.PROVIDER_UNREGISTRATION:
+            if self.registered_providers.pop(msg.get('providerId'), None) is not None:
+                print(f"Unregistered provider {msg.get('providerId')}")
+
     def _listen_as_secondary(self):
         """Secondary provider listens for notifications from primary"""
         while self.running:
             try:
                 self.secondary_sock.settimeout(1.0)  # Short timeout to check running status
-                data, sender_addr = self.secondary_sock.recvfrom(4096)
-                msg = json.loads(data.decode())
-                
-                if msg.get('discoveryType') == MessageTypes.PROVIDER_NOTIFICATION:
-                    # Primary is notifying us of a client discovery request
-                    client_addr = tuple(msg.get('clientAddr', []))
-                    if client_addr:
-                        self.broadcast(target_addr=client_addr)
-
+                data, sender_addr = self.secondary_sock.recvfrom(DISCOVERY_RECV_BUFFER_SIZE)
+                self.handle_secondary_message(decode_datagram(data), sender_addr)
             except socket.timeout:
                 continue  # Normal timeout, check if still running
             except Exception as e:
                 if self.running:
                     print(f"Secondary provider listen error: {e}")
 
-    def _notify_registered_providers(self, client_addr):
-        """Notify all registered providers of a client discovery request"""
+    def handle_secondary_message(self, msg, sender_addr):
+        """Handle one discovery message received by a secondary provider"""
+        self._count_received(msg)
+        if msg.get('discoveryType') == MessageTypes.PROVIDER_NOTIFICATION:
+            # Primary is notifying us of a client discovery request
+            client_addr = tuple(msg.get('clientAddr', []))
+            if client_addr:
+                self.broadcast(target_addr=client_addr, known_schema=msg.get('knownSchema'))
+
+    def _notify_registered_providers(self, client_addr, known_schemas=None, provider_ids=None):
+        """Notify registered providers (all, or those in `provider_ids`) of a client discovery request"""
+        known_schemas = known_schemas or {}
         notification = {
             'discoveryType': MessageTypes.PROVIDER_NOTIFICATION,
             'clientAddr': list(client_addr),
             'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
         }
 
-        # Clean up stale providers (no heartbeat for 60 seconds)
+        # Notify active providers
+        for provider_id, provider_info in self._live_providers().items():
+            if provider_ids is not None and provider_id not in provider_ids:
+                continue
+            try:
+                # Each provider learns which of its schemas the client already holds
+                service_id = provider_info['info'].get('serviceId')
+                notification['knownSchema'] = known_schemas.get(service_id)
+                self._send(notification, provider_info['addr'])
+            except Exception as e:
+                print(f"Error notifying provider {provider_id}: {e}")
+
+    def _live_providers(self):
+        """Registered providers, after dropping those without a heartbeat for 60 seconds"""
         current_time = time.time()
         stale_providers = [
-            pid for pid, info in self.registered_providers.items()
+            pid for pid, info in list(self.registered_providers.items())
             if current_time - info['last_heartbeat'] > 60
         ]
         for pid in stale_providers:
             print(f"Removing stale provider {pid}")
-            del self.registered_providers[pid]
-
-        # Notify active providers
-        for provider_id, provider_info in self.registered_providers.items():
-            try:
-                self.sock.sendto(
-                    json.dumps(notification).encode(),
-                    provider_info['addr']
-                )
-            except Exception as e:
-                print(f"Error notifying provider {provider_id}: {e}")
+            self.registered_providers.pop(pid, None)
+        return dict(self.registered_providers)
+
+    def _local_advertisements(self, known_schemas=None, delta=False):
+        """
+        (msg, data) advertisements of this provider and of every live registered
+        provider, built from the service info secondaries register and send with
+        their heartbeats. Also returns the ids of providers without service info.
+        """
+        known_schemas = known_schemas or {}
+        own_schema = known_schemas.get(self.service_info.get('serviceId'))
+        advertisements = [self._advertisement(self.service_info, self.provider_id, own_schema, delta)]
+        unknown = []
+        for provider_id, provider in self._live_providers().items():
+            info = provider['info']
+            if info:
+                known_schema = known_schemas.get(info.get('serviceId'))
+                advertisements.append(self._advertisement(info, provider_id, known_schema, delta))
+            else:
+                unknown.append(provider_id)
+        return advertisements, unknown
+
+    def _batches(self, advertisements):
+        """
+        Pack (msg, data) advertisements into ServiceAdvertisementBatch datagrams
+        of at most MAX_DATAGRAM_SIZE. A batch that does not fit is halved until
+        it does; a single advertisement is sent as it is.
+        """
+        if len(advertisements) == 1:
+            return list(advertisements)
+        batch = {
+            'discoveryType': MessageTypes.SERVICE_ADVERTISEMENT_BATCH,
+            'providerId': self.provider_id,
+            'advertisements': [msg for msg, _ in advertisements],
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+        data = encode_datagram(batch)
+        if len(data) <= MAX_DATAGRAM_SIZE:
+            return [(batch, data)]
+        middle = len(advertisements) // 2
+        return self._batches(advertisements[:middle]) + self._batches(advertisements[middle:])
+
+    def announce(self):
+        """
+        Primary heartbeat: advertise this provider and every live secondary to
+        clients on each local network. Announcements are deltas; clients that
+        do not hold a schema yet ask this primary for the full advertisement.
+        """
+        advertisements, _ = self._local_advertisements(delta=True)
+        batches = self._batches(advertisements)
+        for ip in get_discovery_targets(DISCOVERY_TRANSPORT_BROADCAST):
+            for batch, data in batches:
+                self._send(batch, (ip, UDP_CLIENT_DISCOVERY_PORT), data)
+
+    def _announced_state(self):
+        """What a heartbeat announces, minus load; the heartbeat interval resets when it changes"""
+        state = [(self.provider_id, schema_version(self.service_info), self.service_info.get('status'))]
+        if self.is_primary:
+            # Copied: in thread mode the listener thread registers providers meanwhile
+            for provider_id, provider in list(self.registered_providers.items()):
+                info = provider['info'] or {}
+                state.append((provider_id, schema_version(info), info.get('status')))
+        else:
+            # The primary answers clients with the info of our last heartbeat,
+            # so large load swings are worth an early heartbeat as well
+            state.append(('load', int(float(self.service_info.get('load') or 0) // LOAD_CHURN_STEP)))
+        return tuple(sorted(state, key=str))
+
+    def _heartbeat(self):
+        """Send one heartbeat and return the delay until the next one"""
+        self.heartbeat_timer.observe(self._announced_state())
+        if self.is_primary:
+            self.announce()
+        else:
+            self._send(self._heartbeat_message(), self.primary_provider_addr)
+        return self.heartbeat_timer.next_delay()
+
+    def _wait_steps(self, delay):
+        """
+        Split the wait for the next heartbeat into steps of at most half the
+        minimum interval, so that a change of the announced state is sent
+        early instead of after a long stable-state delay. Yields step lengths
+        until the delay is over or the state changed.
+        """
+        deadline = time.monotonic() + delay
+        step = self.heartbeat_timer.minimum / 2
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._announced_state() != self.heartbeat_timer.fingerprint:
+                return
+            yield min(step, remaining)
 
     def start(self):
         """Start the discovery service"""
+        self.running = True
+        self.wakeup.clear()
         threading.Thread(target=self.listen, daemon=True).start()
-        # threading.Thread(target=self.periodic_broadcast, daemon=True).start()
 
-        # Secondary providers need to send heartbeats
-        if not self.is_primary:
+        # Primaries announce to clients, secondary providers send heartbeats to the primary
+        if self.is_primary:
+            threading.Thread(target=self.periodic_broadcast, daemon=True).start()
+        else:
             threading.Thread(target=self._send_heartbeats, daemon=True).start()
 
-    # def periodic_broadcast(self):
-    #     """Periodic broadcast - only for primary provider or when no primary found"""
-    #     while self.running:
-    #         if self.is_primary:
-    #             self.broadcast()
-    #         # Secondary providers don't do periodic broadcasts to avoid spam
-    #         time.sleep(HEARTBEAT_INTERVAL_SEC)
+    async def start_async(self):
+        """
+        Run the discovery service on the current event loop (e.g. next to the
+        provider's WebSocket server) instead of in listener and heartbeat threads.
+        """
+        loop = asyncio.get_running_loop()
+        self.running = True
+        if self.is_primary:
+            sock, on_message, name = self.sock, self.handle_primary_message, "Primary provider"
+        else:
+            sock, on_message, name = self.secondary_sock, self.handle_secondary_message, "Secondary provider"
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: DiscoveryDatagramProtocol(on_message, name), sock=sock)
+
+        if self.is_primary or self.primary_provider_addr:
+            self.heartbeat_task = asyncio.ensure_future(self._send_heartbeats_async())
+
+    async def _send_heartbeats_async(self):
+        while self.running:
+            try:
+                delay = self._heartbeat()
+            except Exception as e:
+                print(f"Error sending heartbeat: {e}")
+                delay = self.heartbeat_timer.next_delay()
+            for step in self._wait_steps(delay):
+                await asyncio.sleep(step)
+
+    def _heartbeat_message(self):
+        # Carries the current service info, so the primary announces it fresh
+        return {
+            'discoveryType': MessageTypes.PROVIDER_HEARTBEAT,
+            'providerId': self.provider_id,
+            'serviceInfo': self.service_info,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+
+    def periodic_broadcast(self):
+        """Announce this provider and its secondaries to clients (primary provider only)"""
+        while self.running and self.is_primary:
+            try:
+                delay = self._heartbeat()
+            except Exception as e:
+                print(f"Error announcing providers: {e}")
+                delay = self.heartbeat_timer.next_delay()
+            for step in self._wait_steps(delay):
+                self.wakeup.wait(step)
 
     def _send_heartbeats(self):
         """Send heartbeats to primary provider (secondary providers only)"""
         while self.running and not self.is_primary and self.primary_provider_addr:
             try:
-                heartbeat = {
-                    'discoveryType': MessageTypes.PROVIDER_HEARTBEAT,
-                    'providerId': self.provider_id,
-                    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
-                }
-                self.secondary_sock.sendto(
-                    json.dumps(heartbeat).encode(),
-                    self.primary_provider_addr
-                )
-                time.sleep(30)  # Send heartbeat every 30 seconds
+                delay = self._heartbeat()
             except Exception as e:
                 print(f"Error sending heartbeat: {e}")
-                time.sleep(30)
+                delay = self.heartbeat_timer.next_delay()
+            for step in self._wait_steps(delay):
+                self.wakeup.wait(step)
 
     def stop(self):
         """Stop the discovery service and clean up"""
         self.running = False
+        self.wakeup.set()
 
         # If this is a secondary provider, unregister from primary
         if not self.is_primary and self.primary_provider_addr:
             try:
                 unregister_msg = {
-                    'discoveryType': 'ProviderUnregistration',
+                    'discoveryType': MessageTypes.PROVIDER_UNREGISTRATION,
                     'providerId': self.provider_id,
                     'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
                 }
-                self.secondary_sock.sendto(
-                    json.dumps(unregister_msg).encode(),
-                    self.primary_provider_addr
-                )
+                self._send(unregister_msg, self.primary_provider_addr)
             except Exception as e:
                 print(f"Error unregistering from primary: {e}")
 
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        if self.transport is not None:
+            # Closes the underlying socket as well
+            self.transport.close()
+
         # Close sockets
         try:
             self.sock.close()
@@ -242,15 +479,13 @@ class ServiceDiscoveryBroadcaster:
                     'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
                 }
 
-                self.secondary_sock.sendto(
-                    json.dumps(discovery_msg).encode(), 
-                    ('127.0.0.1', UDP_SERVICE_DISCOVERY_PORT)
-                )
+                self._send(discovery_msg, ('127.0.0.1', UDP_SERVICE_DISCOVERY_PORT))
 
                 # Wait for response
                 self.secondary_sock.settimeout(2.0)  # 2 second timeout
-                data, addr = self.secondary_sock.recvfrom(4096)
-                msg = json.loads(data.decode())
+                data, addr = self.secondary_sock.recvfrom(DISCOVERY_RECV_BUFFER_SIZE)
+                msg = decode_datagram(data)
+                self._count_received(msg)
 
                 if msg.get('discoveryType') == MessageTypes.PROVIDER_DISCOVERY_RESPONSE:
                     self.primary_provider_addr = addr
@@ -279,10 +514,7 @@ class ServiceDiscoveryBroadcaster:
         }
 
         try:
-            self.secondary_sock.sendto(
-                json.dumps(registration_msg).encode(),
-                self.primary_provider_addr
-            )
+            self._send(registration_msg, self.primary_provider_addr)
             print(f"Registered with primary provider at {self.primary_provider_addr}")
         except Exception as e:
             print(f"Error registering with primary provider: {e}")
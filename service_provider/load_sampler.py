@@ -0,0 +1,71 @@
+# Background sampling of provider load for advertisements and status replies
+import threading
+import time
+from shared.discovery import get_cpu_load_average
+
+DEFAULT_SAMPLE_INTERVAL_SEC = 2.0
+
+
+class LoadSampler:
+    """
+    Samples CPU load, in-flight tasks and queue depth every `interval` seconds
+    on a daemon thread and caches them with a composite load score (0-100).
+    get_cpu_load_average() may shell out for seconds on some platforms, so it
+    only ever runs here; readers take `latest` without waiting.
+
+    The score weighs CPU load, the busy-worker share of the busiest pool and
+    queue fill by WEIGHTS.
+    """
+
+    WEIGHTS = {"cpu": 0.3, "workers": 0.5, "queue": 0.2}
+
+    def __init__(self, executor, interval=DEFAULT_SAMPLE_INTERVAL_SEC, on_sample=None, cpu_sampler=get_cpu_load_average):
+        self.executor = executor
+        self.interval = interval
+        self.on_sample = on_sample
+        self.cpu_sampler = cpu_sampler
+        self.latest = {"load": 0.0, "cpuLoad": 0.0, "inFlight": 0, "queueDepth": 0, "sampledAt": None}
+        self.running = False
+        self.wakeup = threading.Event()
+
+    def sample(self):
+        """Take one sample, cache it and hand it to `on_sample`"""
+        try:
+            cpu = float(self.cpu_sampler())
+        except Exception:
+            cpu = self.latest["cpuLoad"]
+        workers = self.executor.utilization()
+        queue_depth = self.executor.queue_depth()
+        queue = min(100.0, 100.0 * queue_depth / max(self.executor.max_queue_size, 1))
+        score = (self.WEIGHTS["cpu"] * cpu + self.WEIGHTS["workers"] * workers +
+                 self.WEIGHTS["queue"] * queue) / sum(self.WEIGHTS.values())
+        # Replace rather than mutate, so readers never see a half-updated sample
+        self.latest = {
+            "load": round(min(max(score, 0.0), 100.0), 1),
+            "cpuLoad": round(cpu, 1),
+            "inFlight": self.executor.in_flight(),
+            "queueDepth": queue_depth,
+            "sampledAt": time.time()
+        }
+        if self.on_sample:
+            self.on_sample(self.latest)
+        return self.latest
+
+    def _run(self):
+        while self.running:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Load sampling error: {e}")
+            self.wakeup.wait(self.interval)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.wakeup.clear()
+        threading.Thread(target=self._run, name="load-sampler", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
@@ -0,0 +1,99 @@
+# Memoized task results for capabilities whose output depends only on their parameters
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL_SEC     = 300
+
+
+def result_key(operation, parameters, service_version):
+    """Canonical hash of a task: same operation, parameters and service version give the same key"""
+    canonical = json.dumps([operation, parameters, service_version], sort_keys=True,
+                           separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    resultData of finished tasks by result_key(), least recently used first.
+    Entries expire `ttl` seconds after they were stored (or the ttl given to
+    put()); past `max_entries` the least recently used entry is dropped.
+
+    Identical tasks running at the same time are coalesced: the first one
+    (the leader) executes, later ones join() it and are finished with its
+    outcome by whoever calls finish().
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL_SEC):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, resultData)
+        self.inflight = {}            # key -> (leader taskId, [waiter, ...] of tasks joined to it)
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "evicted": 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Cached resultData, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                self.counters["evicted"] += 1
+                entry = None
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[1]
+
+    def put(self, key, result_data, ttl=None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + (ttl or self.ttl), result_data)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evicted"] += 1
+
+    def join(self, key, task_id, waiter):
+        """
+        Add `waiter` to the running task with this key and return True, or
+        return False when there is none: task `task_id` then becomes the leader
+        and finish() must be called once it is over.
+        """
+        with self.lock:
+            running = self.inflight.get(key)
+            if running is None:
+                self.inflight[key] = (task_id, [])
+                self.counters["misses"] += 1
+                return False
+            running[1].append(waiter)
+            self.counters["coalesced"] += 1
+            return True
+
+    def leads(self, key, task_id):
+        """True while task `task_id` is the running task of `key`"""
+        with self.lock:
+            running = self.inflight.get(key)
+            return running is not None and running[0] == task_id
+
+    def finish(self, key, task_id):
+        """End the task `task_id` if it leads `key`; returns the waiters that joined it"""
+        with self.lock:
+            running = self.inflight.get(key)
+            if running is None or running[0] != task_id:
+                return []
+            del self.inflight[key]
+            return running[1]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+            stats["inflight"] = len(self.inflight)
+            return stats
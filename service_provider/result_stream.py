@@ -0,0 +1,79 @@
+# Chunked delivery of streamed task results with credit-based flow control
+import asyncio
+from service_provider.ws_server import current_slot
+from shared.messages import build_message, MessageTypes
+
+# Give up on a stream whose client stopped granting credit
+STREAM_CREDIT_TIMEOUT_SEC = 60
+
+_END = object()
+
+
+class ResultStream:
+    """
+    One streamed task result. Chunks are pulled from the capability's
+    generator (sync generators on an executor thread, async generators on the
+    loop) only as fast as the client grants credit, so neither side holds more
+    than a window of chunks in memory. A stream can be consumed once.
+
+    While waiting for credit the stream gives up its connection's in-flight
+    slot: the credit arrives on the same connection, whose reader may need
+    that slot to read it.
+    """
+
+    def __init__(self, task_id, chunks):
+        self.task_id = task_id
+        self.chunks = chunks
+        self.credit = 0
+        self.credit_event = asyncio.Event()
+        self.started = False
+        self.closed = False
+
+    def grant(self, credit):
+        self.credit += credit
+        self.credit_event.set()
+
+    def close(self):
+        """Stop the stream at the next chunk, e.g. when the client stopped reading"""
+        self.closed = True
+        self.credit_event.set()
+
+    async def send(self, websocket, codec, reply_to, executor=None):
+        """Send every chunk to `websocket` as TaskResultChunk frames; returns the number sent"""
+        loop = asyncio.get_running_loop()
+        is_async = hasattr(self.chunks, "__anext__")
+        iterator = self.chunks if is_async else iter(self.chunks)
+        slot = current_slot.get()
+        seq = 0
+        try:
+            while True:
+                while self.credit <= 0 and not self.closed:
+                    if slot is not None:
+                        slot.release()
+                    self.credit_event.clear()
+                    await asyncio.wait_for(self.credit_event.wait(), STREAM_CREDIT_TIMEOUT_SEC)
+                if self.closed:
+                    return seq
+                if slot is not None and not slot.held:
+                    await slot.acquire()
+                if is_async:
+                    chunk = await anext(iterator, _END)
+                else:
+                    # The generator does the work, so it runs off the loop
+                    chunk = await loop.run_in_executor(executor, next, iterator, _END)
+                if chunk is _END:
+                    return seq
+                frame = build_message(MessageTypes.TASK_RESULT_CHUNK, {
+                    "taskId": self.task_id,
+                    "seq": seq,
+                    "data": chunk
+                })
+                frame["replyTo"] = reply_to
+                await websocket.send(codec.encode(frame))
+                seq += 1
+                self.credit -= 1
+        finally:
+            if is_async and hasattr(iterator, "aclose"):
+                await iterator.aclose()
+            elif hasattr(iterator, "close"):
+                iterator.close()
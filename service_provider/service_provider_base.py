@@ -1,9 +1,22 @@
 
 from datetime import datetime
+import asyncio
+import threading
+import time
 import uuid
 import abc
 from service_provider.discovery_service import ServiceDiscoveryBroadcaster
 from service_provider.ws_server import ServiceWebSocketServer
+from service_provider.task_executor import TaskExecutor, ExecutorSaturated, CancelToken, TaskCancelled, EXECUTOR_THREAD, EXECUTOR_PROCESS
+from service_provider.task_store import TaskStore, SqliteResultSpill, FINAL_STATUSES
+from service_provider.result_stream import ResultStream
+from service_provider.load_sampler import LoadSampler
+from service_provider.capability_limits import CapabilityLimiter, CapabilitySaturated, capability_state
+from service_provider.result_cache import ResultCache, result_key
+from shared.messages import build_message, MessageTypes, DEFAULT_STREAM_WINDOW
+from shared.serialization import codec_for
+from shared.metrics import MetricsRegistry, start_metrics_server
+from shared.discovery import SCHEMA_FIELDS, schema_version
 
 class ServiceProviderBase:
     """
@@ -18,18 +31,78 @@ class ServiceProviderBase:
     ENDPOINT        = f"0.0.0.0:{PORT}"
     CAPABILITIES    = []
 
+    # Task execution limits. A capability runs on the process pool when it
+    # declares "executor": "process", otherwise on the thread pool. A capability
+    # declaring "maxConcurrency" runs at most that many tasks at once; up to
+    # "maxQueue" more (default MAX_QUEUE_SIZE) wait for a slot.
+    MAX_WORKERS         = 8
+    MAX_PROCESS_WORKERS = None  # defaults to the CPU count
+    MAX_QUEUE_SIZE      = 64
+
+    # Deadline for tasks whose AssignTask payload has no timeoutMs (None: no deadline)
+    TASK_TIMEOUT_SEC = None
+
+    # Results of capabilities declaring "cacheResults": True are reused for
+    # identical parameters, for "cacheTtlSec" (default RESULT_CACHE_TTL_SEC)
+    RESULT_CACHE_MAX_ENTRIES = 1024
+    RESULT_CACHE_TTL_SEC     = 300
+
+    # Task store limits. Results larger than TASK_RESULT_SPILL_THRESHOLD, or
+    # pushed out by the memory budget, go to a sqlite file when a path is set.
+    # A budget of None keeps every result in memory without sizing it.
+    TASK_STORE_MAX_TASKS        = 10000
+    TASK_TTL_SEC                = 3600
+    FETCHED_RESULT_TTL_SEC      = 60
+    TASK_STORE_MEMORY_BUDGET    = 64 * 1024 * 1024
+    TASK_RESULT_SPILL_PATH      = None
+    TASK_RESULT_SPILL_THRESHOLD = 256 * 1024
+
+    # Most tasks accepted in one AssignTaskBatch/GetStatusBatch/GetResultBatch.
+    # Batch entries may queue MAX_BATCH_QUEUE_SIZE tasks past MAX_QUEUE_SIZE,
+    # so a full batch is queued behind the executor instead of rejected.
+    MAX_BATCH_SIZE       = 1000
+    MAX_BATCH_QUEUE_SIZE = 1000
+
+    # Serve Prometheus-style metrics over HTTP on this port when set
+    METRICS_PORT = None
+
+    # How often the advertised load (CPU, busy workers, queue) is resampled
+    LOAD_SAMPLE_INTERVAL_SEC = 2.0
+
     service_info    = {}
 
     # Store task statuses and results
-    task_store      = {}
+    task_store      = None
 
     def __init__(self, name, version, port, capabilities):
-        self.task_store      = {}
+        spill = SqliteResultSpill(self.TASK_RESULT_SPILL_PATH) if self.TASK_RESULT_SPILL_PATH else None
+        self.task_store      = TaskStore(self.TASK_STORE_MAX_TASKS, self.TASK_TTL_SEC, self.FETCHED_RESULT_TTL_SEC,
+                                         self.TASK_STORE_MEMORY_BUDGET, spill, self.TASK_RESULT_SPILL_THRESHOLD)
         self.SERVICE_NAME    = name
         self.SERVICE_VERSION = version
         self.PORT            = port
         self.CAPABILITIES    = capabilities
         self.ENDPOINT        = f"localhost:{self.PORT}"
+        self.executor        = TaskExecutor(self.MAX_WORKERS, self.MAX_PROCESS_WORKERS, self.MAX_QUEUE_SIZE)
+        self.capability_limiter = CapabilityLimiter(self.CAPABILITIES, self.MAX_QUEUE_SIZE)
+        self.result_cache    = ResultCache(self.RESULT_CACHE_MAX_ENTRIES, self.RESULT_CACHE_TTL_SEC)
+        self.metrics         = MetricsRegistry()
+        self.metrics_server  = None
+        self.load_sampler    = LoadSampler(self.executor, self.LOAD_SAMPLE_INTERVAL_SEC, on_sample=self._publish_load)
+        self._init_metrics()
+
+        # Connections that receive pushed updates for a task: taskId -> {websocket}
+        self.task_subscribers = {}
+        self.subscribers_lock = threading.Lock()
+        # Streamed results waiting for (or being sent on) GetResultStream: taskId -> ResultStream
+        self.result_streams = {}
+        self.streams_lock = threading.Lock()
+        # Cancellation tokens of queued and running tasks: taskId -> CancelToken
+        self.cancel_tokens = {}
+        self.tokens_lock = threading.Lock()
+        self.loop = None
+        self.broadcaster = None
+        self.ws_server = None
 
         self.service_info = {
         "serviceId": self.SERVICE_ID,
@@ -38,19 +111,209 @@ class ServiceProviderBase:
         "endpoint": self.ENDPOINT,
         "capabilities": self.CAPABILITIES,
         "status": "Online",
-        "load": 0.0
+        "load": 0.0,
+        "inFlight": 0,
+        "queueDepth": 0
     }
+        self._update_capability_states()
+
+    def _init_metrics(self):
+        self.task_seconds = self.metrics.histogram(
+            "soa_task_duration_seconds", "Time from assignment to the final status, by operation and status",
+            ["operation", "status"])
+        self.tasks_rejected = self.metrics.counter(
+            "soa_tasks_rejected_total", "Tasks rejected on assignment, by operation and reason",
+            ["operation", "reason"])
+        self.tasks_cancelled = self.metrics.counter(
+            "soa_tasks_cancelled_total", "Tasks cancelled by clients or their deadline, by operation and reason",
+            ["operation", "reason"])
+        self.result_cache_requests = self.metrics.counter(
+            "soa_result_cache_requests_total", "Tasks of cached capabilities, by operation and hit, miss or coalesced",
+            ["operation", "result"])
+        self.metrics.gauge("soa_result_cache_entries", "Results held in the result cache").set_function(
+            lambda: len(self.result_cache))
+        self.metrics.gauge("soa_task_queue_depth", "Tasks waiting for a free worker").set_function(
+            self.executor.queue_depth)
+        self.metrics.gauge("soa_tasks_in_flight", "Tasks queued or running").set_function(
+            self.executor.in_flight)
+        self.metrics.gauge("soa_provider_load", "Load advertised to clients, 0-100").set_function(
+            lambda: self.service_info.get("load", 0.0))
+        self.metrics.gauge("soa_cpu_load", "Last sampled CPU load, 0-100").set_function(
+            lambda: self.load_sampler.latest["cpuLoad"])
+        self.metrics.gauge("soa_task_store_tasks", "Tasks tracked in the task store").set_function(
+            lambda: len(self.task_store))
+        self.metrics.gauge("soa_task_store_memory_bytes", "Result bytes held in memory by the task store").set_function(
+            lambda: self.task_store.memory_bytes)
 
     @abc.abstractmethod
     def handle_assign_task(self, task_id, operation, parameters, base_result):
+        """
+        Do the work for a task of a thread-pool capability. Runs on a worker
+        thread; implementations report progress with update_task_status() and
+        finish with complete_task() or fail_task(). Long-running work should
+        call check_cancelled() between steps, so cancelled tasks and tasks past
+        their deadline free the worker.
+        """
         raise NotImplementedError("Subclasses must implement handle_message method")
-    
+
+    @staticmethod
+    def handle_process_task(operation, parameters):
+        """
+        Do the work for a task of a process-pool capability and return its
+        resultData. Runs in a worker process, so it must be a staticmethod and
+        only use its arguments.
+        """
+        raise NotImplementedError("Subclasses with process capabilities must implement handle_process_task")
+
+    def submit_task(self, task_id, operation, parameters, base_result, headroom=0):
+        """
+        Queue a task on the capability's pool; raises ExecutorSaturated when
+        full. `headroom` extra queue places are open to this task.
+        """
+        kind = self.CAPABILITIES.get(operation, {}).get("executor", EXECUTOR_THREAD)
+        token = self.cancel_token(task_id)
+        if kind == EXECUTOR_PROCESS:
+            future = self.executor.submit(kind, type(self).handle_process_task, operation, parameters,
+                                          token=token, headroom=headroom,
+                                          on_start=lambda: self.update_task_status(task_id, "Running"))
+            future.add_done_callback(lambda f: self._on_process_task_done(f, task_id, base_result))
+        else:
+            future = self.executor.submit(kind, self._run_thread_task, task_id, operation, parameters, base_result,
+                                          headroom=headroom)
+            future.add_done_callback(lambda _: self._update_queue_depth())
+        future.add_done_callback(lambda _: self._release_cancel_token(task_id))
+        if token is not None:
+            # A task cancelled while still queued never takes a worker
+            token.add_callback(future.cancel)
+        self._update_queue_depth()
+        return future
+
+    def cancel_token(self, task_id):
+        """The CancelToken of a queued or running task, or None"""
+        with self.tokens_lock:
+            return self.cancel_tokens.get(task_id)
+
+    def check_cancelled(self, task_id):
+        """Raise TaskCancelled if the task was cancelled or is past its deadline"""
+        token = self.cancel_token(task_id)
+        if token is not None:
+            token.raise_if_cancelled()
+
+    def cancel_task(self, task_id, reason="Cancelled"):
+        """
+        Cancel a queued or running task: it is marked Cancelled and subscribers
+        get a TaskFailed with errorCode CANCELLED (DEADLINE_EXCEEDED for
+        deadlines). Queued tasks never start and process tasks are terminated;
+        thread tasks stop at their next check_cancelled(). Returns False for
+        unknown or finished tasks.
+        """
+        token = self.cancel_token(task_id)
+        return token is not None and token.cancel(reason)
+
+    def _create_cancel_token(self, task_id, operation, timeout_sec, base_result):
+        deadline = time.monotonic() + timeout_sec if timeout_sec else None
+        token = CancelToken(deadline)
+        token.add_callback(lambda: self._record_cancelled(task_id, operation, token, base_result))
+        with self.tokens_lock:
+            self.cancel_tokens[task_id] = token
+        if timeout_sec and self.loop is not None:
+            # Cancel at the deadline even when the handler never checks its token
+            def arm():
+                if not token.cancelled and not token.finished:
+                    token.timer = self.loop.call_later(timeout_sec, token.cancel, "DeadlineExceeded")
+            self.loop.call_soon_threadsafe(arm)
+        return token
+
+    def _release_cancel_token(self, task_id):
+        with self.tokens_lock:
+            token = self.cancel_tokens.pop(task_id, None)
+        if token is None:
+            return
+        # The task is over; a deadline timer armed after this must not fire
+        token.finish()
+        if token.timer is not None and self.loop is not None:
+            self.loop.call_soon_threadsafe(token.timer.cancel)
+
+    def _finish_cancel_token(self, task_id):
+        """Claim the task's final status; False if it was cancelled first"""
+        token = self.cancel_token(task_id)
+        return token is None or token.finish()
+
+    def _record_cancelled(self, task_id, operation, token, base_result):
+        deadline = token.reason == "DeadlineExceeded"
+        failure = build_message(MessageTypes.TASK_FAILED, {
+            "taskId": task_id,
+            "status": "Cancelled",
+            "errorMessage": "Task deadline exceeded" if deadline else "Task cancelled",
+            "errorCode": "DEADLINE_EXCEEDED" if deadline else "CANCELLED",
+            "originalClientId": base_result["payload"].get("originalClientId", "")
+        })
+        self.task_store.set_result(task_id, failure, "Cancelled", reason=token.reason)
+        self.tasks_cancelled.labels(operation, token.reason).inc()
+        self._record_task_finished(task_id, "Cancelled")
+        self._push(task_id, failure, final=True)
+        # Tasks coalesced with this one still want a result
+        self._settle_waiters(task_id)
+
+    def _run_thread_task(self, task_id, operation, parameters, base_result):
+        try:
+            self.check_cancelled(task_id)
+            self.update_task_status(task_id, "Running")
+            self.handle_assign_task(task_id, operation, parameters, base_result)
+        except TaskCancelled:
+            pass  # Already recorded and pushed by cancel_task()
+        except Exception as e:
+            print(f"Task {task_id} ({operation}) failed: {e}")
+            # Errors raised after complete_task() must not turn a delivered result into a failure
+            if self.task_store.get_status(task_id) not in FINAL_STATUSES:
+                self.fail_task(task_id, str(e), base_result)
+
+    def _on_process_task_done(self, future, task_id, base_result):
+        if future.cancelled() or isinstance(future.exception(), TaskCancelled):
+            # Cancelled while queued or terminated; already recorded by cancel_task()
+            self._update_queue_depth()
+            return
+        try:
+            base_result["payload"]["resultData"] = future.result()
+            self.complete_task(task_id, base_result)
+        except Exception as e:
+            print(f"Task {task_id} failed: {e}")
+            self.fail_task(task_id, str(e), base_result)
+        self._update_queue_depth()
+
+    def _update_queue_depth(self):
+        self.service_info["queueDepth"] = self.executor.queue_depth()
+        self._update_capability_states()
+
+    def _update_capability_states(self):
+        """Advertise each capability's status (Ready/Busy/Saturated) and freeSlots"""
+        pools = self.executor.stats()
+        for operation, capability in (self.CAPABILITIES or {}).items():
+            if operation in self.capability_limiter:
+                status, free_slots = self.capability_limiter.state(operation)
+            else:
+                pool = pools[capability.get("executor", EXECUTOR_THREAD)]
+                free_slots = max(0, pool["workers"] - pool["pending"])
+                status = capability_state(free_slots, pool["queued"], pool["capacity"] - pool["workers"])
+            capability["status"] = status
+            capability["freeSlots"] = free_slots
+
+    def _publish_load(self, sample):
+        """Copy the load sampler's latest sample into the advertised service info"""
+        self.service_info.update(load=sample["load"], inFlight=sample["inFlight"], queueDepth=sample["queueDepth"])
+        # Also repairs a capability state overwritten by a racing, older update
+        self._update_capability_states()
+
+    def _record_task_finished(self, task_id, status):
+        task = self.task_store.get(task_id)
+        if task and "assignedAt" in task:
+            self.task_seconds.labels(task.get("operation"), status).observe(time.monotonic() - task["assignedAt"])
+
     def handle_get_status(self, msg, websocket):
-        import json
-        import asyncio
         payload = msg.get("payload", {})
         task_id = payload.get("taskId")
-        task_status = self.task_store.get(task_id, {}).get("status", "Unknown")
+        task = self.task_store.get(task_id, {})
+        task_status = task.get("status", "Unknown")
         status_resp = {
             "type": "Status",
             "serviceId": self.service_info["serviceId"],
@@ -58,42 +321,327 @@ class ServiceProviderBase:
             "taskId": task_id,
             "taskStatus": task_status,
             "status": self.service_info["status"],
-            "load": self.service_info["load"]
+            "load": self.service_info["load"],
+            "queueDepth": self.service_info["queueDepth"]
         }
-        coro = websocket.send(json.dumps(status_resp))
-        if asyncio.iscoroutine(coro):
-            return coro
-        return None
+        if task.get("reason"):
+            status_resp["reason"] = task["reason"]
+        return status_resp
+
+    def handle_get_status_batch(self, msg, websocket):
+        """Statuses of many tasks in one reply; provider fields are sent once"""
+        task_ids = msg.get("payload", {}).get("taskIds", [])
+        if len(task_ids) > self.MAX_BATCH_SIZE:
+            return self._batch_too_large(len(task_ids))
+        return self._status_batch([self._task_status_entry(task_id) for task_id in task_ids])
+
+    def _task_status_entry(self, task_id):
+        task = self.task_store.get(task_id, {})
+        entry = {"taskId": task_id, "taskStatus": task.get("status", "Unknown")}
+        if task.get("reason"):
+            entry["reason"] = task["reason"]
+        return entry
+
+    def _status_batch(self, entries):
+        return {
+            "type": MessageTypes.STATUS_BATCH,
+            "serviceId": self.service_info["serviceId"],
+            "serviceName": self.service_info["serviceName"],
+            "status": self.service_info["status"],
+            "load": self.service_info["load"],
+            "queueDepth": self.service_info["queueDepth"],
+            "tasks": entries
+        }
+
+    def _batch_too_large(self, size):
+        return build_message(MessageTypes.TASK_FAILED, {
+            "status": "Failed",
+            "errorMessage": f"Batch of {size} tasks exceeds the limit of {self.MAX_BATCH_SIZE}",
+            "errorCode": "BATCH_TOO_LARGE"
+        })
 
     def handle_get_result(self, msg, websocket):
-        import json
-        import asyncio
         payload = msg.get("payload", {})
         task_id = payload.get("taskId")
-        result = self.task_store.get(task_id, {}).get("result")
+        result = self.task_store.get_result(task_id)
         if result:
-            coro = websocket.send(json.dumps(result))
-            if asyncio.iscoroutine(coro):
-                return coro
-        else:
-            # No result yet
-            no_result = {"type": "TaskResult", "error": "Result not ready"}
-            coro = websocket.send(json.dumps(no_result))
-            if asyncio.iscoroutine(coro):
-                return coro
+            # Copy so the stored result does not pick up this request's replyTo
+            return dict(result)
+        # No result yet
+        return {"type": "TaskResult", "error": "Result not ready"}
+
+    def handle_get_result_batch(self, msg, websocket):
+        """Results of many tasks in one reply; unfinished tasks are listed in notReady"""
+        task_ids = msg.get("payload", {}).get("taskIds", [])
+        if len(task_ids) > self.MAX_BATCH_SIZE:
+            return self._batch_too_large(len(task_ids))
+        results, not_ready = [], []
+        for task_id in task_ids:
+            result = self.task_store.get_result(task_id)
+            if result:
+                results.append(result)
+            else:
+                not_ready.append(task_id)
+        return {"type": MessageTypes.TASK_RESULT_BATCH, "results": results, "notReady": not_ready}
+
+    def handle_subscribe_task(self, msg, websocket):
+        """Subscribe a connection to pushed updates of a task assigned elsewhere"""
+        task_id = msg.get("payload", {}).get("taskId")
+        result = self.task_store.get_result(task_id)
+        if result:
+            # Already finished: push the result right after the status reply
+            self._push_to(websocket, result)
+        elif task_id in self.task_store:
+            self.subscribe_task(task_id, websocket)
+        return self.handle_get_status(msg, websocket)
+
+    def handle_get_descriptor(self, msg, websocket):
+        """Full service descriptor, for clients that received a pointer advertisement"""
+        descriptor = {field: self.service_info.get(field) for field in SCHEMA_FIELDS}
+        descriptor["type"] = MessageTypes.DESCRIPTOR
+        descriptor["serviceId"] = self.service_info["serviceId"]
+        descriptor["schemaVersion"] = schema_version(self.service_info)
+        return descriptor
+
+    def subscribe_task(self, task_id, websocket):
+        with self.subscribers_lock:
+            self.task_subscribers.setdefault(task_id, set()).add(websocket)
+
+    def unsubscribe_task(self, task_id):
+        with self.subscribers_lock:
+            self.task_subscribers.pop(task_id, None)
+
+    def update_task_status(self, task_id, status, **details):
+        """Record a status change and push a TaskStatusUpdate to the task's subscribers"""
+        if not self.task_store.set_status(task_id, status):
+            return
+        payload = {"taskId": task_id, "status": status}
+        payload.update(details)
+        self._push(task_id, build_message(MessageTypes.TASK_STATUS_UPDATE, payload))
+
+    def complete_task(self, task_id, base_result):
+        """Store the final result and push it to the task's subscribers. Safe to call from worker threads."""
+        if not self._finish_cancel_token(task_id):
+            return  # Cancelled meanwhile; the client no longer wants the result
+        base_result["payload"]["status"] = "Completed"
+        self.task_store.set_result(task_id, base_result, "Done")
+        self._record_task_finished(task_id, "Done")
+        self._push(task_id, base_result, final=True)
+        self._settle_waiters(task_id, result=base_result)
+
+    def complete_task_stream(self, task_id, base_result, chunks):
+        """
+        Finish a task whose result is delivered in chunks, for capabilities that
+        declare "streaming": True. `chunks` is a generator or async generator; it
+        runs only when a client requests the result with GetResultStream, at the
+        pace the client consumes it. Subscribers get a TaskResult with
+        "streamed": True instead of the resultData.
+        """
+        with self.streams_lock:
+            # Forget streams whose task was evicted before anyone fetched them
+            for stale in [t for t in self.result_streams if t not in self.task_store]:
+                del self.result_streams[stale]
+            self.result_streams[task_id] = ResultStream(task_id, chunks)
+        base_result["payload"]["streamed"] = True
+        base_result["payload"]["resultData"] = None
+        self.complete_task(task_id, base_result)
+
+    async def handle_get_result_stream(self, msg, websocket):
+        """Send a streamed result as TaskResultChunk frames; the reply is TaskResultEnd"""
+        payload = msg.get("payload", {})
+        task_id = payload.get("taskId")
+        with self.streams_lock:
+            stream = self.result_streams.get(task_id)
+            if stream is not None and stream.started:
+                stream = None
+            elif stream is not None:
+                stream.started = True
+        if stream is None:
+            return build_message(MessageTypes.TASK_FAILED, {
+                "taskId": task_id,
+                "status": "Failed",
+                "errorMessage": "No result stream available for this task",
+                "errorCode": "STREAM_UNAVAILABLE"
+            })
+
+        stream.grant(payload.get("credit", DEFAULT_STREAM_WINDOW))
+        try:
+            sent = await stream.send(websocket, codec_for(websocket.subprotocol), msg.get("messageId"))
+        except Exception as e:
+            print(f"Result stream of task {task_id} failed: {e}")
+            return build_message(MessageTypes.TASK_FAILED, {
+                "taskId": task_id,
+                "status": "Failed",
+                "errorMessage": str(e),
+                "errorCode": "STREAM_FAILED"
+            })
+        finally:
+            with self.streams_lock:
+                self.result_streams.pop(task_id, None)
+        return build_message(MessageTypes.TASK_RESULT_END, {
+            "taskId": task_id,
+            "status": "Cancelled" if stream.closed else "Completed",
+            "chunks": sent
+        })
+
+    async def handle_stream_credit(self, msg, websocket):
+        """Let a result stream send more chunks, or stop it when the client closes it"""
+        payload = msg.get("payload", {})
+        with self.streams_lock:
+            stream = self.result_streams.get(payload.get("taskId"))
+        if stream is not None:
+            if payload.get("close"):
+                stream.close()
+            else:
+                stream.grant(payload.get("credit", 0))
         return None
 
-    def dummy_service_logic_base(self, msg, websocket):
+    def fail_task(self, task_id, error_message, base_result, error_code=None):
+        """Mark a task failed and push a TaskFailed message to its subscribers"""
+        if not self._finish_cancel_token(task_id):
+            return
+        failure = build_message(MessageTypes.TASK_FAILED, {
+            "taskId": task_id,
+            "status": "Failed",
+            "errorMessage": error_message,
+            "errorCode": error_code,
+            "originalClientId": base_result["payload"].get("originalClientId", "")
+        })
+        self.task_store.set_result(task_id, failure, "Failed")
+        self._record_task_finished(task_id, "Failed")
+        self._push(task_id, failure, final=True)
+        self._settle_waiters(task_id, failure=failure)
+
+    def _result_cache_key(self, operation, parameters):
+        """result_key() of a task, or None when its capability does not cache results"""
+        if not self.CAPABILITIES[operation].get("cacheResults"):
+            return None
+        return result_key(operation, parameters, self.SERVICE_VERSION)
+
+    def _settle_waiters(self, task_id, result=None, failure=None, cache_key=None):
+        """
+        When `task_id` led coalesced identical tasks: cache its result and
+        finish the waiting tasks with it, or with its failure. After a
+        cancellation (or a streamed result, which cannot be shared) the
+        waiting tasks run on their own instead.
+        """
+        task = self.task_store.get(task_id) or {}
+        cache_key = cache_key or task.get("cacheKey")
+        # Only the task that executed stores its result: re-storing cache hits
+        # would keep extending the TTL of a hot key
+        if cache_key is None or not self.result_cache.leads(cache_key, task_id):
+            return
+        payload = result["payload"] if result is not None else {}
+        shareable = result is not None and not payload.get("streamed")
+        if shareable:
+            ttl = self.CAPABILITIES[task["operation"]].get("cacheTtlSec")
+            self.result_cache.put(cache_key, payload.get("resultData"), ttl)
+        for waiter_id, operation, parameters, waiter_result in self.result_cache.finish(cache_key, task_id):
+            if shareable:
+                waiter_result["payload"]["resultData"] = payload.get("resultData")
+                self.complete_task(waiter_id, waiter_result)
+            elif failure is not None:
+                self.fail_task(waiter_id, failure["payload"]["errorMessage"], waiter_result,
+                               failure["payload"].get("errorCode"))
+            else:
+                self._dispatch_task(waiter_id, operation, parameters, waiter_result, cache_key, deferred=True)
+                continue
+            self._release_cancel_token(waiter_id)
+
+    def _push(self, task_id, message, final=False):
+        with self.subscribers_lock:
+            if final:
+                subscribers = self.task_subscribers.pop(task_id, set())
+            else:
+                subscribers = set(self.task_subscribers.get(task_id, ()))
+        if not subscribers or self.loop is None:
+            return
+        if final:
+            # Delivered by push, so the result only needs to outlive a late GetResult
+            self.task_store.mark_fetched(task_id)
+        # Encode once per wire format in use among the subscribers
+        encoded = {}
+        for websocket in subscribers:
+            codec = codec_for(websocket.subprotocol)
+            if codec.subprotocol not in encoded:
+                encoded[codec.subprotocol] = codec.encode(message)
+            data = encoded[codec.subprotocol]
+            asyncio.run_coroutine_threadsafe(self._send_push(task_id, websocket, data), self.loop)
+
+    def _push_to(self, websocket, message):
+        data = codec_for(websocket.subprotocol).encode(message)
+        asyncio.run_coroutine_threadsafe(self._send_push(None, websocket, data), self.loop)
+
+    async def _send_push(self, task_id, websocket, data):
+        try:
+            await websocket.send(data)
+        except Exception:
+            # Connection went away; stop pushing to it
+            with self.subscribers_lock:
+                self.task_subscribers.get(task_id, set()).discard(websocket)
+
+    def message_handlers(self):
+        """Handlers registered with the WebSocket server, by message type"""
+        return {
+            MessageTypes.ASSIGN_TASK: self.handle_assign_message,
+            MessageTypes.GET_STATUS: self.handle_get_status,
+            MessageTypes.GET_RESULT: self.handle_get_result,
+            MessageTypes.SUBSCRIBE_TASK: self.handle_subscribe_task,
+            MessageTypes.GET_DESCRIPTOR: self.handle_get_descriptor,
+            MessageTypes.GET_RESULT_STREAM: self.handle_get_result_stream,
+            MessageTypes.ASSIGN_TASK_BATCH: self.handle_assign_batch,
+            MessageTypes.GET_STATUS_BATCH: self.handle_get_status_batch,
+            MessageTypes.GET_RESULT_BATCH: self.handle_get_result_batch,
+            MessageTypes.STREAM_CREDIT: self.handle_stream_credit,
+            MessageTypes.CANCEL_TASK: self.handle_cancel_task
+        }
+
+    def handle_assign_message(self, msg, websocket):
+        task_id = self._assign_task(msg.get("payload", {}), msg.get("messageId", ""), websocket)
+        return self.handle_get_status({"payload": {"taskId": task_id}}, websocket)
+
+    def handle_cancel_task(self, msg, websocket):
+        """Cancel a task; the reply is its status, "Cancelled" unless it had already finished"""
+        task_id = msg.get("payload", {}).get("taskId")
+        self.cancel_task(task_id)
+        return self.handle_get_status({"payload": {"taskId": task_id}}, websocket)
+
+    def handle_assign_batch(self, msg, websocket):
+        """
+        Assign many tasks with one message. Each entry of payload.tasks has the
+        fields of an AssignTask payload. Results are pushed per task unless
+        payload.subscribe is false, in which case the client collects them
+        with GetResultBatch.
+        """
+        payload = msg.get("payload", {})
+        tasks = payload.get("tasks", [])
+        if len(tasks) > self.MAX_BATCH_SIZE:
+            return self._batch_too_large(len(tasks))
+        subscribe = payload.get("subscribe", True)
+        message_id = msg.get("messageId", "")
+        entries = []
+        for index, task in enumerate(tasks):
+            task_id = self._assign_task(task, f"{message_id}-{index}", websocket if subscribe else None,
+                                        self.MAX_BATCH_QUEUE_SIZE)
+            entries.append(self._task_status_entry(task_id))
+        return self._status_batch(entries)
+
+    def _assign_task(self, payload, message_id, websocket, headroom=0):
+        """
+        Create and queue one task; `websocket`, when given, gets its updates
+        pushed and `headroom` extra executor queue places are open to it.
+        Returns the taskId.
+        """
         import uuid
 
-        payload    = msg.get("payload", {})
         task_id    = payload.get("taskId", str(uuid.uuid4()))
         parameters = payload.get("taskParameters", {})
+        operation  = payload.get("operation")
 
         # Mark as processing
         base_result = {
             "type": "TaskResult",
-            "messageId": msg.get("messageId", "") + "-result",
+            "messageId": message_id + "-result",
             "timestamp": datetime.now().isoformat() + "Z",
             "payload": {
                 "taskId": task_id,
@@ -103,30 +651,130 @@ class ServiceProviderBase:
             }
         }
 
-        if msg.get("type") == "AssignTask":
-            operation = payload.get("operation")
-            self.task_store[task_id] = {"status": "Processing", "result": None}
-            self.CAPABILITIES[operation]["status"] = "Busy"
+        if operation not in self.CAPABILITIES:
+            self.task_store.create(task_id, "Rejected", reason="UnknownOperation")
+            self.tasks_rejected.labels("unknown", "UnknownOperation").inc()
+            return task_id
 
-            self.handle_assign_task(task_id, operation, parameters, base_result)
+        cache_key = self._result_cache_key(operation, parameters)
+        self.task_store.create(task_id, "Queued", operation=operation, assignedAt=time.monotonic(),
+                               cacheKey=cache_key)
+        # The assigning connection gets status updates and the result pushed to it
+        if websocket is not None:
+            self.subscribe_task(task_id, websocket)
 
-            return self.handle_get_status(msg, websocket)
+        if cache_key is not None:
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                self.result_cache_requests.labels(operation, "hit").inc()
+                base_result["payload"]["resultData"] = cached
+                self.complete_task(task_id, base_result)
+                return task_id
 
-        elif msg.get("type") == "GetStatus":
-            return self.handle_get_status(msg, websocket)
+        # Deadline relative to assignment, so clocks of client and provider need not agree
+        timeout_ms = payload.get("timeoutMs")
+        timeout_sec = timeout_ms / 1000.0 if timeout_ms else self.TASK_TIMEOUT_SEC
+        self._create_cancel_token(task_id, operation, timeout_sec, base_result)
+        self._dispatch_task(task_id, operation, parameters, base_result, cache_key, headroom=headroom)
+        self._update_capability_states()
 
-        elif msg.get("type") == "GetResult":
-            return self.handle_get_result(msg, websocket)
+        return task_id
 
-        return None
+    def _dispatch_task(self, task_id, operation, parameters, base_result, cache_key, deferred=False, headroom=0):
+        """
+        Run a task, or join an identical one already running. A task the
+        provider cannot take is rejected, or failed when `deferred` (its
+        client was already told it is Queued).
+        """
+        if cache_key is not None:
+            joined = self.result_cache.join(cache_key, task_id, (task_id, operation, parameters, base_result))
+            self.result_cache_requests.labels(operation, "coalesced" if joined else "miss").inc()
+            if joined:
+                return
+        try:
+            self.capability_limiter.admit(operation, lambda deferred_start: self._start_task(
+                task_id, operation, parameters, base_result, deferred or deferred_start, headroom))
+        except (ExecutorSaturated, CapabilitySaturated) as e:
+            # Backpressure: tell the client to retry later or pick another provider
+            reason = "Saturated" if isinstance(e, CapabilitySaturated) else "Busy"
+            self.tasks_rejected.labels(operation, reason).inc()
+            if deferred:
+                self.fail_task(task_id, f"Provider is {reason.lower()}", base_result, "PROVIDER_SATURATED")
+            else:
+                self.task_store.create(task_id, "Rejected", reason=reason)
+                self.unsubscribe_task(task_id)
+            self._release_cancel_token(task_id)
+            if cache_key is not None:
+                # Identical tasks that joined meanwhile run on their own
+                self._settle_waiters(task_id, cache_key=cache_key)
+
+    def _start_task(self, task_id, operation, parameters, base_result, deferred, headroom=0):
+        """
+        Submit a task once its capability has a free slot. `deferred` tasks
+        waited for the slot, so a full executor fails them instead of raising.
+        Returns False when the task no longer needs the slot.
+        """
+        token = self.cancel_token(task_id)
+        if token is not None and token.cancelled:
+            # Cancelled (or past its deadline) while waiting for the slot
+            self._release_cancel_token(task_id)
+            return False
+        try:
+            future = self.submit_task(task_id, operation, parameters, base_result, headroom)
+        except ExecutorSaturated:
+            if not deferred:
+                raise
+            self.fail_task(task_id, "Task queue is full", base_result, "PROVIDER_SATURATED")
+            self._release_cancel_token(task_id)
+            return False
+        if operation in self.capability_limiter:
+            future.add_done_callback(lambda _: self._release_capability_slot(operation))
+        return True
+
+    def _release_capability_slot(self, operation):
+        self.capability_limiter.release(operation)
+        self._update_capability_states()
+
+    def dummy_service_logic_base(self, msg, websocket):
+        """Single entry point routing a message to its handler; returns the response dict"""
+        handler = self.message_handlers().get(msg.get("type"))
+        if handler is None:
+            return None
+        return handler(msg, websocket)
+
+    def get_status(self):
+        """Introspection of the provider: discovery state, executor and task store counters"""
+        status = self.broadcaster.get_status() if self.broadcaster else {'service_info': self.service_info}
+        status['executor'] = self.executor.stats()
+        status['task_store'] = self.task_store.stats()
+        status['result_cache'] = self.result_cache.stats()
+        return status
 
+    async def start_server(self, host='0.0.0.0'):
+        """Start the WebSocket server on the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.load_sampler.start()
+        self.ws_server = ServiceWebSocketServer(host, self.PORT, None, None, metrics=self.metrics)
+        for msg_type, handler in self.message_handlers().items():
+            # Status lookups are cheap enough to answer on the loop without a thread hop.
+            # Stream credit bypasses the per-connection limit: streams waiting for it hold slots.
+            self.ws_server.register_handler(msg_type, handler, offload=msg_type != MessageTypes.GET_STATUS,
+                                            inline=msg_type == MessageTypes.STREAM_CREDIT)
+        if self.METRICS_PORT:
+            self.metrics_server = await start_metrics_server(self.metrics, host, self.METRICS_PORT)
+            print(f"Serving metrics on http://{host}:{self.METRICS_PORT}/metrics")
+        return await self.ws_server.start()
 
     def run(self):
-        broadcaster = ServiceDiscoveryBroadcaster(self.service_info)
-        broadcaster.start()
-        ws_server = ServiceWebSocketServer('0.0.0.0', self.PORT, None, None, self.dummy_service_logic_base)
+        self.broadcaster = ServiceDiscoveryBroadcaster(self.service_info, self.metrics)
 
-        import asyncio
-        asyncio.get_event_loop().run_until_complete(ws_server.start())
-        asyncio.get_event_loop().run_forever()
+        # Discovery runs on the same event loop as the WebSocket server
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.start_server())
+        loop.run_until_complete(self.broadcaster.start_async())
+        try:
+            loop.run_forever()
+        finally:
+            self.load_sampler.stop()
+            self.broadcaster.stop()
 
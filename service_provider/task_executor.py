@@ -0,0 +1,233 @@
+# Bounded task execution for service providers
+import concurrent.futures
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+
+EXECUTOR_THREAD  = "thread"
+EXECUTOR_PROCESS = "process"
+
+# Task processes start fresh instead of forking the provider, whose event loop,
+# sockets and held locks would be copied into the child mid-use
+PROCESS_START_METHOD = "spawn"
+
+
+class ExecutorSaturated(Exception):
+    """Raised when every worker is busy and the task queue is full"""
+
+
+class TaskCancelled(Exception):
+    """Raised inside a task whose CancelToken was cancelled; the message is the reason"""
+
+
+class CancelToken:
+    """
+    Cancellation flag of one task, shared by the provider and the worker
+    running it. Thread tasks poll it (raise_if_cancelled) at convenient
+    points; process tasks register a callback that terminates their process.
+    `deadline` is a time.monotonic() value after which the task counts as
+    cancelled with reason "DeadlineExceeded".
+    """
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.reason = None
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.finished = False
+        self.timer = None  # provider's deadline timer, cancelled when the task ends
+
+    @property
+    def cancelled(self):
+        if not self.event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("DeadlineExceeded")
+        return self.event.is_set()
+
+    def cancel(self, reason="Cancelled"):
+        """Cancel the task; returns False if it was already cancelled or finished"""
+        with self.lock:
+            if self.event.is_set() or self.finished:
+                return False
+            self.reason = reason
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Cancel callback failed: {e}")
+        return True
+
+    def finish(self):
+        """Mark the task finished; returns False if it was cancelled first"""
+        with self.lock:
+            if self.event.is_set():
+                return False
+            self.finished = True
+            self.callbacks = []
+            return True
+
+    def add_callback(self, callback):
+        """Call `callback` on cancellation, right away if already cancelled"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def remaining(self):
+        """Seconds left until the deadline, or None without one"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise TaskCancelled(self.reason)
+
+
+def _process_entry(conn, fn, args):
+    try:
+        conn.send((True, fn(*args)))
+    except BaseException as e:
+        conn.send((False, f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def run_in_process(fn, args, token=None, on_start=None):
+    """
+    Run fn(*args) in a dedicated child process and return its result. The
+    process is terminated when `token` is cancelled, raising TaskCancelled.
+    `on_start()` is called just before the process starts. The child is
+    spawned, so fn and args must be picklable and fn importable by module.
+    A ProcessPoolExecutor cannot stop one running task: terminating a pool
+    worker breaks the whole pool.
+    """
+    if token is not None:
+        token.raise_if_cancelled()
+    if on_start is not None:
+        on_start()
+    context = multiprocessing.get_context(PROCESS_START_METHOD)
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_process_entry, args=(sender, fn, args), daemon=True)
+    process.start()
+    sender.close()
+    if token is not None:
+        token.add_callback(process.terminate)
+    try:
+        while True:
+            # Wake up for the deadline even if nobody cancels explicitly
+            timeout = token.remaining() if token is not None else None
+            ready = multiprocessing.connection.wait([receiver, process.sentinel], timeout)
+            if token is not None and token.cancelled:
+                process.terminate()
+                raise TaskCancelled(token.reason)
+            if receiver in ready:
+                ok, value = receiver.recv()
+                if not ok:
+                    raise RuntimeError(value)
+                return value
+            if process.sentinel in ready:
+                raise RuntimeError(f"Task process exited with code {process.exitcode}")
+    finally:
+        if token is not None:
+            token.remove_callback(process.terminate)
+        process.join(1)
+        receiver.close()
+
+
+class TaskExecutor:
+    """
+    Runs task handlers on a thread pool (I/O-bound capabilities) or in child
+    processes (CPU-bound capabilities; at most `max_process_workers` at a time,
+    one process per task so that a cancelled task can be terminated). Each
+    pool accepts at most its worker count plus `max_queue_size` unfinished
+    tasks; submit() raises ExecutorSaturated beyond that so the provider can
+    answer with a Rejected status instead of queueing without limit. Callers
+    may grant a task `headroom` extra queue places (used for batch entries).
+    """
+
+    def __init__(self, max_workers=8, max_process_workers=None, max_queue_size=64):
+        self.workers = {
+            EXECUTOR_THREAD: max_workers,
+            EXECUTOR_PROCESS: max_process_workers or os.cpu_count() or 1
+        }
+        self.max_queue_size = max_queue_size
+        self.pending = {EXECUTOR_THREAD: 0, EXECUTOR_PROCESS: 0}  # submitted, not finished
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def submit(self, kind, fn, *args, token=None, headroom=0, on_start=None):
+        """
+        Run fn(*args) on the `kind` pool and return its concurrent.futures.Future.
+        Process tasks are terminated when `token` is cancelled; `on_start()` is
+        called on the supervising thread when a process task leaves the queue.
+        """
+        with self.lock:
+            if self.pending[kind] >= self.workers[kind] + self.max_queue_size + headroom:
+                raise ExecutorSaturated(f"{kind} pool is full ({self.pending[kind]} tasks pending)")
+            self.pending[kind] += 1
+            pool = self._get_pool(kind)
+
+        try:
+            if kind == EXECUTOR_PROCESS:
+                future = pool.submit(run_in_process, fn, args, token, on_start)
+            else:
+                future = pool.submit(fn, *args)
+        except Exception:
+            self._finished(kind)
+            raise
+        future.add_done_callback(lambda _: self._finished(kind))
+        return future
+
+    def _get_pool(self, kind):
+        if kind not in self.pools:
+            # Process tasks are supervised by one thread each, which bounds the child processes
+            prefix = "process-task" if kind == EXECUTOR_PROCESS else "task-worker"
+            self.pools[kind] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers[kind], thread_name_prefix=prefix)
+        return self.pools[kind]
+
+    def _finished(self, kind):
+        with self.lock:
+            self.pending[kind] -= 1
+
+    def in_flight(self):
+        with self.lock:
+            return sum(self.pending.values())
+
+    def queue_depth(self):
+        """Number of accepted tasks still waiting for a free worker"""
+        with self.lock:
+            return sum(max(0, self.pending[kind] - self.workers[kind]) for kind in self.pending)
+
+    def utilization(self):
+        """Percentage of busy workers in the busiest pool, 0-100"""
+        with self.lock:
+            return max(100.0 * min(self.pending[kind], self.workers[kind]) / self.workers[kind]
+                       for kind in self.pending)
+
+    def stats(self):
+        with self.lock:
+            return {
+                kind: {
+                    "workers": self.workers[kind],
+                    "pending": self.pending[kind],
+                    "queued": max(0, self.pending[kind] - self.workers[kind]),
+                    "capacity": self.workers[kind] + self.max_queue_size
+                }
+                for kind in self.pending
+            }
+
+    def shutdown(self, wait=False):
+        for pool in self.pools.values():
+            pool.shutdown(wait=wait, cancel_futures=True)
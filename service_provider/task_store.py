@@ -0,0 +1,288 @@
+# Bounded storage for task statuses and results on a service provider
+import heapq
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from shared.serialization import JSON_CODEC
+
+# Statuses after which a task no longer changes and may be evicted
+FINAL_STATUSES = ("Done", "Failed", "Rejected", "Cancelled")
+
+# Containers nested deeper than this are sized shallowly by estimate_size()
+SIZE_ESTIMATE_DEPTH = 3
+
+
+def estimate_size(value, depth=0):
+    """
+    Rough size of a result in bytes without serializing it: lengths of strings
+    and bytes, walking the first SIZE_ESTIMATE_DEPTH levels of containers
+    (a result message, its payload and resultData) and sys.getsizeof below
+    """
+    if isinstance(value, (str, bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (dict, list, tuple)) and depth < SIZE_ESTIMATE_DEPTH:
+        items = value.items() if isinstance(value, dict) else enumerate(value)
+        return sys.getsizeof(value) + sum(estimate_size(item, depth + 1) for _, item in items)
+    return sys.getsizeof(value)
+
+
+class SqliteResultSpill:
+    """Keeps large task results in a sqlite file instead of provider memory"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (task_id TEXT PRIMARY KEY, data TEXT)")
+        self.lock = threading.Lock()
+
+    def put(self, task_id, data):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?)", (task_id, data))
+            self.conn.commit()
+
+    def get(self, task_id):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM results WHERE task_id = ?", (task_id,)).fetchone()
+        return JSON_CODEC.decode(row[0]) if row else None
+
+    def delete(self, task_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM results WHERE task_id = ?", (task_id,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class TaskStore:
+    """
+    Task statuses and results with bounded memory.
+
+    Finished tasks expire `ttl` seconds after their last update, or
+    `fetched_ttl` seconds after their result was delivered. Past `max_tasks`
+    the least recently used finished task is dropped. Results count against
+    `memory_budget` bytes (estimate_size(), not sized at all when there is
+    neither a budget nor a spill); when it is exceeded, least recently used
+    results move to `spill` if one is configured and are dropped otherwise.
+    Results larger than `spill_threshold` go to the spill directly.
+
+    Spill reads and writes happen outside `lock`, which GetStatus takes on the
+    event loop: a result stays in memory until its row has been written.
+    """
+
+    def __init__(self, max_tasks=10000, ttl=3600, fetched_ttl=60, memory_budget=64 * 1024 * 1024,
+                 spill=None, spill_threshold=256 * 1024):
+        self.max_tasks = max_tasks
+        self.ttl = ttl
+        self.fetched_ttl = fetched_ttl
+        self.memory_budget = memory_budget
+        self.spill = spill
+        self.spill_threshold = spill_threshold
+        self.tasks = OrderedDict()  # taskId -> entry, least recently used first
+        self.expiry_heap = []       # (expires_at, taskId); stale items are skipped
+        self.memory_bytes = 0
+        self.lock = threading.RLock()
+        # Spill writes and deletes queued under `lock`, done by _flush_spill() after releasing it
+        self.spill_writes = []   # (taskId, entry, result)
+        self.spill_deletes = []  # taskIds
+        self.spill_lock = threading.Lock()  # Keeps queued spill I/O in order
+        self.counters = {
+            "evictedExpired": 0,
+            "evictedCapacity": 0,
+            "evictedMemory": 0,
+            "spilled": 0,
+            "spillReads": 0
+        }
+
+    def __contains__(self, task_id):
+        with self.lock:
+            return task_id in self.tasks
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def create(self, task_id, status="Queued", **extra):
+        with self.lock:
+            self._drop(task_id)
+            entry = {"status": status, "result": None, "size": 0, "spilled": False, "expires": None}
+            entry.update(extra)
+            self.tasks[task_id] = entry
+            if status in FINAL_STATUSES:
+                self._schedule_expiry(task_id, entry, self.ttl)
+            self._evict()
+        self._flush_spill()
+
+    def get(self, task_id, default=None):
+        """Status metadata of a task, without loading its result"""
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None or self._expired(entry):
+                return default
+            return {k: v for k, v in entry.items() if k != "result"}
+
+    def get_status(self, task_id):
+        return (self.get(task_id) or {}).get("status", "Unknown")
+
+    def set_status(self, task_id, status):
+        """Update a known, unfinished task's status; returns False for unknown, evicted or finished tasks"""
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None or entry["status"] in FINAL_STATUSES:
+                return False
+            entry["status"] = status
+            self.tasks.move_to_end(task_id)
+            if status in FINAL_STATUSES:
+                self._schedule_expiry(task_id, entry, self.ttl)
+            return True
+
+    def set_result(self, task_id, result, status="Done", **extra):
+        sized = self.memory_budget is not None or self.spill is not None
+        size = estimate_size(result) if sized else 0
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None:
+                entry = self.tasks[task_id] = {"result": None, "size": 0, "spilled": False, "expires": None}
+            self._release_result(task_id, entry)
+            entry["status"] = status
+            entry.update(extra)
+            entry["size"] = size
+            entry["result"] = result
+            if self.spill is not None and entry["size"] > self.spill_threshold:
+                self._queue_spill(task_id, entry)
+            else:
+                self.memory_bytes += entry["size"]
+            self.tasks.move_to_end(task_id)
+            self._schedule_expiry(task_id, entry, self.ttl)
+            self._evict()
+        self._flush_spill()
+
+    def get_result(self, task_id, mark_fetched=True):
+        """Return a task's result, shortening its lifetime once it has been delivered"""
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is None or self._expired(entry):
+                return None
+            result = entry["result"]
+            spilled = entry["spilled"]
+            if mark_fetched and (result is not None or spilled):
+                self.mark_fetched(task_id)
+            if spilled:
+                self.counters["spillReads"] += 1
+            self.tasks.move_to_end(task_id)
+        if spilled:
+            return self.spill.get(task_id)
+        return result
+
+    def mark_fetched(self, task_id):
+        with self.lock:
+            entry = self.tasks.get(task_id)
+            if entry is not None and not entry.get("fetched"):
+                entry["fetched"] = True
+                self._schedule_expiry(task_id, entry, min(self.ttl, self.fetched_ttl))
+
+    def stats(self):
+        with self.lock:
+            self._evict()
+            stats = dict(self.counters)
+            stats["tasks"] = len(self.tasks)
+            stats["memoryBytes"] = self.memory_bytes
+            stats["memoryBudget"] = self.memory_budget
+        self._flush_spill()
+        return stats
+
+    def _schedule_expiry(self, task_id, entry, ttl):
+        entry["expires"] = time.monotonic() + ttl
+        heapq.heappush(self.expiry_heap, (entry["expires"], task_id))
+
+    def _expired(self, entry):
+        return entry["expires"] is not None and entry["expires"] <= time.monotonic()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires, task_id = heapq.heappop(self.expiry_heap)
+            entry = self.tasks.get(task_id)
+            # Skip heap items superseded by a later reschedule
+            if entry is not None and entry["expires"] == expires:
+                self._drop(task_id)
+                self.counters["evictedExpired"] += 1
+
+        excess = len(self.tasks) - self.max_tasks
+        if excess > 0:
+            # Oldest entries are usually finished, so this stops after a few steps
+            victims = []
+            for task_id, entry in self.tasks.items():
+                if entry["status"] in FINAL_STATUSES:
+                    victims.append(task_id)
+                    if len(victims) >= excess:
+                        break
+            for task_id in victims:
+                self._drop(task_id)
+                self.counters["evictedCapacity"] += 1
+
+        if self.memory_budget is not None and self.memory_bytes > self.memory_budget:
+            for task_id, entry in list(self.tasks.items()):
+                if self.memory_bytes <= self.memory_budget:
+                    break
+                if entry["result"] is None or entry.get("spilling"):
+                    continue
+                if self.spill is not None:
+                    self.memory_bytes -= entry["size"]
+                    self._queue_spill(task_id, entry)
+                else:
+                    self._drop(task_id)
+                    self.counters["evictedMemory"] += 1
+
+        # Keep the heap from growing with superseded items
+        if len(self.expiry_heap) > 2 * len(self.tasks) + 64:
+            self.expiry_heap = [(e["expires"], t) for t, e in self.tasks.items() if e["expires"] is not None]
+            heapq.heapify(self.expiry_heap)
+
+    def _queue_spill(self, task_id, entry):
+        """Mark a result for the spill; it no longer counts against the budget"""
+        entry["spilling"] = True
+        self.spill_writes.append((task_id, entry, entry["result"]))
+
+    def _flush_spill(self):
+        """Do the spill I/O queued under `lock`; call without holding it"""
+        if self.spill is None:
+            return
+        with self.spill_lock:
+            with self.lock:
+                writes, self.spill_writes = self.spill_writes, []
+                deletes, self.spill_deletes = self.spill_deletes, []
+            for task_id in deletes:
+                self.spill.delete(task_id)
+            for task_id, entry, result in writes:
+                if not self._spill_pending(task_id, entry, result):
+                    continue
+                self.spill.put(task_id, JSON_CODEC.encode(result))
+                with self.lock:
+                    if self._spill_pending(task_id, entry, result):
+                        entry.pop("spilling")
+                        entry["result"] = None
+                        entry["spilled"] = True
+                        self.counters["spilled"] += 1
+                        continue
+                # Replaced or dropped while being written
+                self.spill.delete(task_id)
+
+    def _spill_pending(self, task_id, entry, result):
+        with self.lock:
+            return self.tasks.get(task_id) is entry and entry["result"] is result
+
+    def _release_result(self, task_id, entry):
+        if entry["result"] is not None:
+            if not entry.pop("spilling", False):
+                self.memory_bytes -= entry["size"]
+            entry["result"] = None
+        if entry["spilled"]:
+            self.spill_deletes.append(task_id)
+            entry["spilled"] = False
+
+    def _drop(self, task_id):
+        entry = self.tasks.pop(task_id, None)
+        if entry is not None:
+            self._release_result(task_id, entry)
@@ -1,14 +1,79 @@
 # WebSocket server for service provider (WSS)
 import asyncio
+import contextvars
+import time
 import websockets
-import json
 from shared.messages import MessageTypes, build_message
+from shared.metrics import MetricsRegistry
+from shared.serialization import SUPPORTED_SUBPROTOCOLS, codec_for
+
+DEFAULT_MAX_IN_FLIGHT_PER_CONNECTION = 64
+
+
+class InFlightSlot:
+    """The in-flight slot of one message; handlers that wait on the client release it meanwhile"""
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.held = False
+
+    async def acquire(self):
+        await self.semaphore.acquire()
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.semaphore.release()
+
+
+# Slot of the message being handled, for coroutine handlers that wait on the client
+current_slot = contextvars.ContextVar("current_slot", default=None)
+
 
 class ServiceWebSocketServer:
-    def __init__(self, host, port, ssl_cert, ssl_key, service_logic):
+    """
+    Dispatches incoming messages to handlers registered per message type.
+
+    Messages of one connection are processed concurrently, up to
+    `max_in_flight` at a time; reading from the connection pauses beyond that.
+    Coroutine handlers run on the event loop. Plain functions run in
+    `executor` (the loop's default executor when None) together with the
+    encoding of their response, so slow handlers never stall other
+    connections; handlers registered with offload=False are cheap enough to
+    run on the loop directly. Handlers registered with inline=True are awaited
+    by the connection's reader itself, outside the in-flight limit: control
+    messages such as StreamCredit must get through even when every slot is
+    held by a request waiting for them. Coroutine handlers that wait on the
+    client (result streams waiting for credit) release their slot through
+    `current_slot` meanwhile, so the reader never stalls behind them. A handler returns a response dict, which is sent
+    back with `replyTo` set to the request's messageId, or None.
+
+    The wire format is negotiated per connection through the WebSocket
+    subprotocol (see shared/serialization.py); clients that offer none get JSON.
+
+    Messages, handler latency and connections are counted in `metrics`.
+    """
+
+    def __init__(self, host, port, ssl_cert, ssl_key, service_logic=None, executor=None,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT_PER_CONNECTION, metrics=None):
         self.host = host
         self.port = port
+        # Fallback for message types without a registered handler
         self.service_logic = service_logic
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.handlers = {}  # msg_type -> (handler, offload)
+        self.inline_types = set()  # msg_types handled by the reader, outside the in-flight limit
+        self.metrics = metrics or MetricsRegistry()
+        self.messages_total = self.metrics.counter(
+            "soa_ws_messages_total", "WebSocket messages received, by message type", ["type"])
+        self.handler_seconds = self.metrics.histogram(
+            "soa_ws_handler_seconds", "Time to handle a WebSocket message and encode its response", ["type"])
+        self.handler_errors = self.metrics.counter(
+            "soa_ws_handler_errors_total", "WebSocket messages whose handling raised", ["type"])
+        self.active_connections = self.metrics.gauge(
+            "soa_ws_active_connections", "Open WebSocket connections")
         if ssl_cert and ssl_key:
             import ssl
             self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
@@ -16,19 +81,92 @@ class ServiceWebSocketServer:
         else:
             self.ssl_context = None
 
-    async def handler(self, websocket, path):
-        async for message in websocket:
-            try:
-                msg = json.loads(message)
-                response = await self.service_logic(msg, websocket)
-                if response:
-                    await websocket.send(json.dumps(response))
-            except Exception as e:
-                print(f"WebSocket error: {e}")
+    def register_handler(self, msg_type, handler, offload=True, inline=False):
+        """Handle messages of `msg_type` with handler(msg, websocket)"""
+        self.handlers[msg_type] = (handler, offload and not inline)
+        if inline:
+            self.inline_types.add(msg_type)
+        else:
+            self.inline_types.discard(msg_type)
+
+    async def handler(self, websocket, path=None):
+        codec = codec_for(websocket.subprotocol)
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        self.active_connections.inc()
+        try:
+            async for message in websocket:
+                try:
+                    msg = codec.decode(message)
+                except Exception as e:
+                    self.messages_total.labels("undecodable").inc()
+                    self.handler_errors.labels("undecodable").inc()
+                    print(f"WebSocket error: {e}")
+                    continue
+                if isinstance(msg, dict) and msg.get("type") in self.inline_types:
+                    await self._process(msg, websocket, codec)
+                    continue
+                slot = InFlightSlot(in_flight)
+                await slot.acquire()
+                task = asyncio.ensure_future(self._process(msg, websocket, codec, slot))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            self.active_connections.dec()
+
+    async def _process(self, msg, websocket, codec, slot=None):
+        started = time.perf_counter()
+        msg_type = "unsupported"
+        current_slot.set(slot)
+        try:
+            # Label unknown types with one value so clients cannot grow the metric without bound
+            msg_type = msg.get("type") if msg.get("type") in self.handlers else "unsupported"
+            data = await self.dispatch(msg, websocket, codec)
+            if data is not None:
+                await websocket.send(data)
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            self.handler_errors.labels(msg_type).inc()
+            print(f"WebSocket error: {e}")
+        finally:
+            if slot is not None:
+                slot.release()
+            self.messages_total.labels(msg_type).inc()
+            self.handler_seconds.labels(msg_type).observe(time.perf_counter() - started)
+
+    async def dispatch(self, msg, websocket, codec):
+        """Run the handler for a message and return its encoded response, if any"""
+        handler, offload = self.handlers.get(msg.get("type"), (self.service_logic, True))
+        if handler is None:
+            response = build_message(MessageTypes.TASK_FAILED, {
+                "status": "Failed",
+                "errorMessage": f"Unsupported message type: {msg.get('type')}",
+                "errorCode": "UNSUPPORTED_MESSAGE"
+            })
+            return self.encode_response(msg, response, codec)
+
+        if asyncio.iscoroutinefunction(handler):
+            return self.encode_response(msg, await handler(msg, websocket), codec)
+        if not offload:
+            return self._run_sync_handler(handler, msg, websocket, codec)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._run_sync_handler, handler, msg, websocket, codec)
+
+    def _run_sync_handler(self, handler, msg, websocket, codec):
+        return self.encode_response(msg, handler(msg, websocket), codec)
+
+    def encode_response(self, msg, response, codec):
+        if response is None:
+            return None
+        response.setdefault("replyTo", msg.get("messageId"))
+        return codec.encode(response)
 
     def start(self):
         """Start the WebSocket server and return the server coroutine"""
         if self.ssl_context:
-            return websockets.serve(self.handler, self.host, self.port, ssl=self.ssl_context)
+            return websockets.serve(self.handler, self.host, self.port, ssl=self.ssl_context,
+                                    subprotocols=SUPPORTED_SUBPROTOCOLS)
         else:
-            return websockets.serve(self.handler, self.host, self.port)
+            return websockets.serve(self.handler, self.host, self.port, subprotocols=SUPPORTED_SUBPROTOCOLS)
@@ -1,6 +1,11 @@
 # UDP Discovery constants and utilities
+import asyncio
+import hashlib
+import json
 import socket
 import ipaddress
+import random
+import zlib
 try:
     import netifaces
     NETIFACES_AVAILABLE = True
@@ -12,8 +17,117 @@ UDP_SERVICE_DISCOVERY_PORT = 50001
 UDP_CLIENT_DISCOVERY_PORT  = 4096
 # Support multiple network ranges for cross-subnet discovery
 DEFAULT_BROADCAST_NETWORKS = ['192.168.50.0']
+# How clients reach providers on every refresh:
+#   'sweep'     - unicast to every host of DEFAULT_BROADCAST_NETWORKS (255 packets per network)
+#   'broadcast' - one packet per local interface broadcast address
+#   'multicast' - one packet per interface to DISCOVERY_MULTICAST_GROUP
+DISCOVERY_TRANSPORT_SWEEP = 'sweep'
+DISCOVERY_TRANSPORT_BROADCAST = 'broadcast'
+DISCOVERY_TRANSPORT_MULTICAST = 'multicast'
+DEFAULT_DISCOVERY_TRANSPORT = DISCOVERY_TRANSPORT_BROADCAST
+DISCOVERY_MULTICAST_GROUP = '239.255.50.1'
+DISCOVERY_MULTICAST_TTL = 1  # stay on the local network segment
 HEARTBEAT_INTERVAL_SEC = 30
+# Heartbeat intervals adapt between these bounds: back to the minimum on churn
+# (registrations, schema or status changes), doubling while nothing changes
+HEARTBEAT_MIN_INTERVAL_SEC = 2
 SERVICE_EXPIRY_MULTIPLIER = 3  # e.g., 3x heartbeat interval
+# Datagrams larger than this are zlib-compressed, so typical advertisements
+# fit in one Ethernet frame instead of relying on IP fragmentation
+DATAGRAM_COMPRESS_THRESHOLD = 1200
+# Advertisements still larger once compressed are replaced by a pointer:
+# clients fetch the full descriptor with GetDescriptor over WebSocket.
+# 1500-byte Ethernet MTU minus IP/UDP headers, with room for tunnels and VLAN tags
+MAX_DATAGRAM_SIZE = 1400
+# Receive buffers take any UDP datagram, so nothing is silently truncated
+DISCOVERY_RECV_BUFFER_SIZE = 65535
+# Compressed datagrams may not inflate beyond this; larger ones are dropped,
+# so a small datagram cannot make every listener allocate a zip bomb
+MAX_DECOMPRESSED_DATAGRAM_SIZE = 64 * 1024
+# Advertisement fields that describe the service rather than its current state.
+# Clients that already hold the current schemaVersion get a delta without them.
+SCHEMA_FIELDS = ('serviceName', 'serviceVersion', 'endpoint', 'capabilities')
+# Capability fields that describe its current state; not part of the schema
+CAPABILITY_STATE_FIELDS = ('status', 'freeSlots')
+
+
+def _capability_items(capabilities):
+    """(key, description) pairs of capabilities given as a dict or a list of {"key": ...}"""
+    if isinstance(capabilities, dict):
+        return list(capabilities.items())
+    return [(cap.get('key'), cap) for cap in capabilities or [] if isinstance(cap, dict)]
+
+
+def schema_version(service_info):
+    """Short hash of a service's SCHEMA_FIELDS, ignoring capability states (CAPABILITY_STATE_FIELDS)"""
+    schema = {field: service_info.get(field) for field in SCHEMA_FIELDS if field != 'capabilities'}
+    schema['capabilities'] = [
+        [key, {k: v for k, v in cap.items() if k not in CAPABILITY_STATE_FIELDS}]
+        for key, cap in _capability_items(service_info.get('capabilities'))
+    ]
+    canonical = json.dumps(schema, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:12]
+
+
+def capability_statuses(capabilities):
+    """{capability key: status} for the capabilities that report one"""
+    return {key: cap['status'] for key, cap in _capability_items(capabilities) if 'status' in cap}
+
+
+def capability_free_slots(capabilities):
+    """{capability key: freeSlots} for the capabilities that report them"""
+    return {key: cap['freeSlots'] for key, cap in _capability_items(capabilities) if 'freeSlots' in cap}
+
+
+def encode_datagram(msg):
+    """Serialize a discovery message, compressing it above DATAGRAM_COMPRESS_THRESHOLD"""
+    data = json.dumps(msg).encode()
+    if len(data) > DATAGRAM_COMPRESS_THRESHOLD:
+        data = zlib.compress(data)
+    return data
+
+
+def decode_datagram(data):
+    # Our JSON always starts with '{'; anything else is a zlib stream
+    if data[:1] != b'{':
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(data, MAX_DECOMPRESSED_DATAGRAM_SIZE)
+        if inflater.unconsumed_tail:
+            raise ValueError(f"Datagram inflates beyond {MAX_DECOMPRESSED_DATAGRAM_SIZE} bytes")
+    return json.loads(data.decode())
+
+
+# Fields of delta and pointer advertisements that are not part of the service info
+PARTIAL_ADVERTISEMENT_FIELDS = ('delta', 'descriptorRef', 'capabilityStatus', 'capabilitySlots')
+
+
+def merge_advertisement(base, partial):
+    """Full service info from `base` (a cached advertisement or descriptor) and a delta or pointer advertisement"""
+    merged = dict(base)
+    merged.update((k, v) for k, v in partial.items() if k not in PARTIAL_ADVERTISEMENT_FIELDS)
+    if partial.get('capabilityStatus') or partial.get('capabilitySlots'):
+        merged['capabilities'] = with_capability_statuses(
+            base.get('capabilities'), partial.get('capabilityStatus') or {}, partial.get('capabilitySlots'))
+    return merged
+
+
+def with_capability_statuses(capabilities, statuses, free_slots=None):
+    """Copy of `capabilities` with the statuses (and free slots) of a delta advertisement applied"""
+    free_slots = free_slots or {}
+
+    def apply(key, cap):
+        if key not in statuses and key not in free_slots:
+            return cap
+        cap = dict(cap)
+        if key in statuses:
+            cap['status'] = statuses[key]
+        if key in free_slots:
+            cap['freeSlots'] = free_slots[key]
+        return cap
+
+    if isinstance(capabilities, dict):
+        return {key: apply(key, cap) for key, cap in capabilities.items()}
+    return [apply(cap.get('key'), cap) if isinstance(cap, dict) else cap for cap in capabilities or []]
 
 
 def get_local_ip():
@@ -81,6 +195,91 @@ def get_broadcast_addresses():
 
     return target_networks
 
+def get_interface_broadcast_addresses():
+    """Get the broadcast address of every local interface, one entry per subnet"""
+    addresses = []
+    for interface in get_network_interfaces():
+        broadcast = calculate_broadcast_address(interface['ip'], interface['netmask'])
+        if broadcast not in addresses:
+            addresses.append(broadcast)
+
+    return addresses or ['255.255.255.255']
+
+
+def get_discovery_targets(transport=DEFAULT_DISCOVERY_TRANSPORT):
+    """Get the destination addresses a discovery request is sent to for a transport"""
+    if transport == DISCOVERY_TRANSPORT_MULTICAST:
+        return [DISCOVERY_MULTICAST_GROUP]
+    if transport == DISCOVERY_TRANSPORT_BROADCAST:
+        return get_interface_broadcast_addresses()
+    return get_broadcast_addresses()
+
+
+def join_multicast_group(sock, group=DISCOVERY_MULTICAST_GROUP):
+    """Subscribe a bound UDP socket to the discovery multicast group on every interface"""
+    joined = False
+    interfaces = get_network_interfaces() or [{'interface': 'any', 'ip': '0.0.0.0'}]
+    for interface in interfaces:
+        membership = socket.inet_aton(group) + socket.inet_aton(interface['ip'])
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            joined = True
+        except OSError as e:
+            print(f"Could not join multicast group {group} on {interface['interface']}: {e}")
+    return joined
+
+
+class DiscoveryDatagramProtocol(asyncio.DatagramProtocol):
+    """Decodes discovery datagrams on an event loop and hands them to `on_message(msg, addr)`"""
+
+    def __init__(self, on_message, name="Discovery"):
+        self.on_message = on_message
+        self.name = name
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            self.on_message(decode_datagram(data), addr)
+        except Exception as e:
+            print(f"{self.name} listen error: {e}")
+
+    def error_received(self, exc):
+        print(f"{self.name} socket error: {exc}")
+
+
+class AdaptiveInterval:
+    """
+    Heartbeat timer in the style of Trickle (RFC 6206). next_delay() returns a
+    random delay in [interval/2, interval) and then doubles the interval up to
+    `maximum`; observe() drops it back to `minimum` whenever the fingerprint of
+    the announced state changes. Random delays keep providers that started
+    together from sending in lockstep.
+    """
+
+    def __init__(self, minimum=HEARTBEAT_MIN_INTERVAL_SEC, maximum=HEARTBEAT_INTERVAL_SEC):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.interval = minimum
+        self.fingerprint = None
+
+    def observe(self, fingerprint):
+        """Reset to the minimum interval if `fingerprint` differs from the last one seen"""
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self.reset()
+
+    def reset(self):
+        self.interval = self.minimum
+
+    def next_delay(self):
+        delay = random.uniform(self.interval / 2, self.interval)
+        self.interval = min(self.interval * 2, self.maximum)
+        return delay
+
+
 def get_local_network():
     """Get the local network subnet"""
     local_ip = get_local_ip()
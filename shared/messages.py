@@ -12,22 +12,42 @@ def iso_timestamp() -> str:
     return datetime.utcnow().isoformat() + 'Z'
 
 
+# Chunks a client may receive of a streamed result before granting more credit
+DEFAULT_STREAM_WINDOW = 16
+
+
 # Message format helpers
 class MessageTypes:
     ASSIGN_TASK = "AssignTask"
+    ASSIGN_TASK_BATCH = "AssignTaskBatch"
     CANCEL_TASK = "CancelTask"
+    GET_STATUS = "GetStatus"
+    GET_RESULT = "GetResult"
+    GET_STATUS_BATCH = "GetStatusBatch"
+    GET_RESULT_BATCH = "GetResultBatch"
+    GET_RESULT_STREAM = "GetResultStream"
+    STREAM_CREDIT = "StreamCredit"
+    SUBSCRIBE_TASK = "SubscribeTask"
+    GET_DESCRIPTOR = "GetDescriptor"
+    DESCRIPTOR = "Descriptor"
     TASK_STATUS_UPDATE = "TaskStatusUpdate"
     TASK_RESULT = "TaskResult"
+    TASK_RESULT_CHUNK = "TaskResultChunk"
+    TASK_RESULT_END = "TaskResultEnd"
+    STATUS_BATCH = "StatusBatch"
+    TASK_RESULT_BATCH = "TaskResultBatch"
     TASK_FAILED = "TaskFailed"
     ACK = "Ack"
     CLIENT_DISCOVERY_REQUEST = "ClientServiceDiscoveryRequest"
     SERVICE_ADVERTISEMENT = "ServiceAdvertisement"
+    SERVICE_ADVERTISEMENT_BATCH = "ServiceAdvertisementBatch"
     # Multi-provider discovery messages
     PROVIDER_DISCOVERY_REQUEST = "ProviderDiscoveryRequest"
     PROVIDER_DISCOVERY_RESPONSE = "ProviderDiscoveryResponse"
     PROVIDER_REGISTRATION = "ProviderRegistration"
     PROVIDER_NOTIFICATION = "ProviderNotification"
     PROVIDER_HEARTBEAT = "ProviderHeartbeat"
+    PROVIDER_UNREGISTRATION = "ProviderUnregistration"
 
 
 def build_message(msg_type: str, payload: Dict[str, Any], message_id: str = None, timestamp: str = None) -> Dict[str, Any]:
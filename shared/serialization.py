@@ -0,0 +1,72 @@
+# Wire formats for WebSocket messages, negotiated per connection as a WebSocket subprotocol
+import base64
+import json
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+SUBPROTOCOL_JSON    = "soa.json"
+SUBPROTOCOL_MSGPACK = "soa.msgpack"
+
+WIRE_FORMAT_JSON    = "json"
+WIRE_FORMAT_MSGPACK = "msgpack"
+
+
+def _encode_extra(value):
+    # bytes have no JSON form; carry them as base64 in a marker object
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"__bytes__": base64.b64encode(value).decode()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode_extra(obj):
+    if len(obj) == 1 and "__bytes__" in obj:
+        return base64.b64decode(obj["__bytes__"])
+    return obj
+
+
+class JsonCodec:
+    """Text frames; bytes values survive the round trip as base64"""
+    subprotocol = SUBPROTOCOL_JSON
+
+    def encode(self, message):
+        return json.dumps(message, default=_encode_extra)
+
+    def decode(self, data):
+        return json.loads(data, object_hook=_decode_extra)
+
+
+class MsgpackCodec:
+    """Binary frames; bytes values are carried as-is without base64"""
+    subprotocol = SUBPROTOCOL_MSGPACK
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+JSON_CODEC = JsonCodec()
+CODECS = {SUBPROTOCOL_JSON: JSON_CODEC}
+if MSGPACK_AVAILABLE:
+    CODECS[SUBPROTOCOL_MSGPACK] = MsgpackCodec()
+
+# Servers offer every available format, most compact first
+SUPPORTED_SUBPROTOCOLS = [p for p in (SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON) if p in CODECS]
+
+
+def client_subprotocols(wire_format=None):
+    """Subprotocols a client offers, in order of preference; None prefers the most compact"""
+    if wire_format == WIRE_FORMAT_JSON:
+        return [SUBPROTOCOL_JSON]
+    if wire_format == WIRE_FORMAT_MSGPACK and not MSGPACK_AVAILABLE:
+        raise ValueError("msgpack wire format requested but the msgpack package is not installed")
+    return list(SUPPORTED_SUBPROTOCOLS)
+
+
+def codec_for(subprotocol):
+    """Codec of a negotiated subprotocol; peers that negotiated nothing speak JSON"""
+    return CODECS.get(subprotocol, JSON_CODEC)
@@ -0,0 +1,46 @@
+# Streamed task results over one connection
+import asyncio
+from benchmarks.common import BenchProvider, ProviderThread
+from client.connection_pool import ConnectionPool
+from client.ws_client import ServiceWebSocketClient
+from service_provider.ws_server import DEFAULT_MAX_IN_FLIGHT_PER_CONNECTION
+from shared.messages import build_message, MessageTypes
+
+
+class StreamingProvider(BenchProvider):
+    def __init__(self, port):
+        super().__init__(port)
+        self.CAPABILITIES["chunks"] = {"status": "Ready", "settings": [], "streaming": True}
+
+    def handle_assign_task(self, task_id, operation, parameters, base_result):
+        if operation != "chunks":
+            return super().handle_assign_task(task_id, operation, parameters, base_result)
+        self.complete_task_stream(task_id, base_result, iter(range(parameters["n"])))
+
+
+def test_more_streams_than_in_flight_slots_on_one_connection():
+    # Every stream outlives its first window, so each one needs StreamCredit
+    # frames while all in-flight slots of the connection are held by streams
+    streams, chunks, window = DEFAULT_MAX_IN_FLIGHT_PER_CONNECTION + 16, 20, 4
+    provider = ProviderThread(StreamingProvider(8797)).start()
+    pool = ConnectionPool(max_connections_per_endpoint=1)
+    try:
+        client = ServiceWebSocketClient(provider.endpoint, pool=pool)
+        for i in range(streams):
+            client.submit_task(build_message(MessageTypes.ASSIGN_TASK, {
+                "taskId": f"s{i}", "operation": "chunks", "taskParameters": {"n": chunks}
+            })).result(10)
+
+        async def collect(task_id):
+            return [chunk async for chunk in client.stream_result(task_id, window=window, timeout=10)]
+
+        async def collect_all():
+            return await asyncio.wait_for(
+                asyncio.gather(*[collect(f"s{i}") for i in range(streams)]), 30)
+
+        results = asyncio.run(collect_all())
+        assert results == [list(range(chunks))] * streams
+        assert pool.stats()[provider.endpoint]["connections"] == 1
+    finally:
+        pool.close()
+        provider.stop()